@@ -3,14 +3,19 @@
 # This is a dummy peer that just illustrates the available information your peers 
 # have available.  The setup script will copy it to create the versions you edit
 
-import random
 import logging
 
 from messages import Upload, Request
 from util import even_split
 from peer import Peer
+from pieceset import PieceSet
 
 class AclaStd(Peer):
+    # Uses downloads[round-1], [round-2] and uploads[round-1]
+    history_window = 2
+    idle_when_done = True
+    idle_without_requests = True
+
     def post_init(self):
         print("post_init(): %s here!" % self.id)
         ##################################################################################
@@ -30,43 +35,37 @@ class AclaStd(Peer):
         #Calculate the pieces you still need
         needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
         needed_pieces = list(filter(needed, list(range(len(self.pieces)))))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
+        np_set = PieceSet(needed_pieces)  # bitsets intersect in one AND
 
 
-        logging.debug("%s here: still need pieces %s" % (
-            self.id, needed_pieces))
+        logging.debug("%s here: still need pieces %s",
+                      self.id, needed_pieces)
 
         #This code shows you what you have access to in peers and history
         #You won't need it in your final solution, but may want to uncomment it
         #and see what it does to help you get started
         """
-        logging.debug("%s still here. Here are some peers:" % self.id)
-        for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
-
-        logging.debug("And look, I have my entire history available too:")
-        logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("%s still here. Here are some peers:", self.id)
+            for p in peers:
+                logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
+
+            logging.debug("And look, I have my entire history available too:")
+            logging.debug("look at the AgentHistory class in history.py for details")
+            logging.debug("%s", history)
         """
 
         # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
+        self.rng.shuffle(needed_pieces)
 
         # count frequencies of all pieces that the other peers have
         # this will be useful for implementing rarest first
         peers.sort(key=lambda p: p.id)
 
         # first we need to find the rarest piece
-        frequencies = {}
-        for peer in peers:
-            # get set of available pieces for all peers
-            rare_set = set(peer.available_pieces)
-            for piece in rare_set:
-                if piece not in frequencies.keys():
-                    frequencies[piece] = [1, [peer.id]]
-                else:
-                    frequencies[piece][0] += 1
-                    frequencies[piece][1].append(peer.id)
+        # the sim keeps count of how many peers have each piece, so we
+        # don't have to go through every peer's pieces ourselves
+        frequencies = history.piece_counts
         
         requests = []   # We'll put all the things we want here
 
@@ -76,11 +75,11 @@ class AclaStd(Peer):
         # This code now implements the rarest first algorithm                       #
         #############################################################################
         for peer in peers:
-            # pieces this peer has available
-            av_set = set(peer.available_pieces)
-
-            # intersection between what user needs and what other peers have
-            isect = av_set.intersection(np_set)
+            # intersection between what user needs and what this peer has
+            available = peer.available_pieces
+            if available.isdisjoint(np_set):
+                continue
+            isect = available & np_set
 
             if self.max_requests >= len(isect):
                 # request message from peers added to requests
@@ -93,7 +92,7 @@ class AclaStd(Peer):
                 isect_list = []
                 # number of peers who have this piece and what piece
                 for piece in isect:
-                    isect_list.append((frequencies[piece][0],piece))
+                    isect_list.append((frequencies[piece],piece))
 
                # sort according to first index, which is # of peers who own it
                 isect_list.sort()
@@ -109,7 +108,7 @@ class AclaStd(Peer):
                         sameRareList.append(elem[1])
 
                 # order should be random   
-                random.shuffle(sameRareList)
+                self.rng.shuffle(sameRareList)
 
                 # merge shuffled rarest list and the rest together
                 secondList = []
@@ -143,7 +142,7 @@ class AclaStd(Peer):
         # here i am using 1 round to represent 10 seconds
         round = history.current_round()
 
-        logging.debug("%s again.  It's round %d." % (self.id, round))
+        logging.debug("%s again.  It's round %d.", self.id, round)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
@@ -187,8 +186,8 @@ class AclaStd(Peer):
 
                 # append up to 4 random peers to lilst
                 for i in range(0, 4):
-                    if len(requests) != 0:
-                        request = random.choice(requesters)
+                    if len(requesters) != 0:
+                        request = self.rng.choice(requesters)
                         chosen.append(request)
                         requesters.remove(request)
                
@@ -230,7 +229,7 @@ class AclaStd(Peer):
                 # if top 3 slots aren't taken, randomly pick peers to unchoke
                 for i in range(Slots):
                     if len(requests) != 0:
-                        request = random.choice(requests)
+                        request = self.rng.choice(requests)
                         tempList.append(request.requester_id)
                         requests.remove(request)
 
@@ -262,14 +261,14 @@ class AclaStd(Peer):
                             # add random peer to extra slot
                             for i in range(4 - len(tempList)):
                                 if len(requests) != 0:
-                                    request = random.choice(requests)
+                                    request = self.rng.choice(requests)
                                     chosen.append(request.requester_id)
                                     requests.remove(request)
                 else:
                     chosen = tempList
                     if len(requests) > 0:
                         # optimistic unchoking
-                        request = random.choice(requests)
+                        request = self.rng.choice(requests)
                         chosen.append(request.requester_id)
 
             
@@ -0,0 +1,407 @@
+#!/usr/bin/python
+
+"""
+Runs the agents' calls in parallel: in worker processes instead of the
+simulator's process (sim.py --isolation process), or on a thread pool
+inside it (--isolation thread).
+
+Every worker owns some of the peers, and keeps its own mirror of the state
+they are allowed to see: their pieces, every peer's available pieces, the
+swarm's piece counts and their own history.  The sim never hands out its
+live objects.  Each round is two batched exchanges per worker:
+
+  requests: ("requests", round, completed, downloads, uploads, neighbors)
+      completed: [(peer_id, piece_id)] pieces finished last round, in order
+      downloads: peer_id -> [(from_id, piece, blocks)] for its own peers
+      uploads: peer_id -> [(to_id, bw)] for its own peers
+      neighbors: peer_id -> [neighbor ids], for its own peers whose
+      neighbors changed (see topology.py).  Peers that never got a list
+      see every other peer.
+    reply: [(peer_id, [(requester_id, peer_id, piece_id, start)], wall, cpu,
+             error)]
+
+  uploads: ("uploads", requests)
+      requests: peer_id -> [(requester_id, piece_id, start)] made to its own
+      peers, or None to skip that peer's call
+    reply: [(peer_id, [(from_id, to_id, bw)], wall, cpu, error)]
+
+error is a formatted traceback if the agent raised (its list is then
+empty), None otherwise.  The mirrors are updated in the same order as the
+sim's state, so a seeded run gives the same results as running in process.
+
+With a --time-budget, a worker that takes far longer than its agents'
+budgets to reply (see AgentPool.timeout) is taken to be hung.  It is
+stopped, like a worker that dies, and its peers' calls give empty lists
+from then on: the round it happens with an error, as for a crash.
+
+ThreadAgentPool has the same interface, and runs the calls of the sim's own
+agents on threads.  That only pays off on a free-threaded python build.
+Either way, the replies come back in peer order.
+"""
+
+import logging
+import multiprocessing
+import random
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from messages import Upload, Request, Download, PeerInfo
+from collections import deque
+from history import AgentHistory, RoundWindow, agent_windows
+from topology import NeighborhoodCounts
+from pieceset import MutablePieceSet
+from piecestate import make_piece_state
+from timing import clock, timed_call
+from util import ReadOnlyList, derive_seed
+
+
+class RemotePeer:
+    """Stands in for an agent in the sim's process: just its id and bandwidth"""
+    __slots__ = ("id", "up_bw")
+
+    def __init__(self, id, up_bw):
+        self.id = id
+        self.up_bw = up_bw
+
+
+class AgentWorker:
+    """
+    The agents owned by one worker process, and their view of the simulation.
+    initial_pieces: dict : peer_id -> [blocks / piece] or UniformPieces, for
+    every peer.  The worker's own agents get a mirror of their blocks / piece
+    in the same piece state engine as the sim's.
+    """
+    def __init__(self, conf, seed, peer_ids, my_ids, initial_pieces, up_bws):
+        self.conf = conf
+        bpp = conf.blocks_per_piece
+        self.my_ids = my_ids
+        self.piece_state = make_piece_state(conf.piece_engine, my_ids,
+                                            initial_pieces, bpp)
+        self.available = dict(
+            (pid, MutablePieceSet(i for (i, b) in enumerate(initial_pieces[pid])
+                                  if b == bpp))
+            for pid in peer_ids)
+        self.piece_counts = [0] * conf.num_pieces
+        for pid in peer_ids:
+            for piece_id in self.available[pid]:
+                self.piece_counts[piece_id] += 1
+        self.piece_counts_view = ReadOnlyList(self.piece_counts)
+
+        self.views = dict((pid, self.piece_state.pieces(pid)) for pid in my_ids)
+        self.peer_info = [PeerInfo(pid, self.available[pid]) for pid in peer_ids]
+        self.peer_info_by_id = dict((info.id, info) for info in self.peer_info)
+        self.neighbors = dict()
+        self.local_counts = NeighborhoodCounts(conf.num_pieces, self.available)
+        class_of = dict(zip(peer_ids, conf.agent_class_names))
+
+        # As in a StreamingHistory, only keep the rounds the agents need
+        windows = dict((pid, None) for pid in my_ids)
+        if conf.history == "stream":
+            windows = agent_windows(
+                my_ids, [conf.agent_classes[class_of[pid]] for pid in my_ids],
+                conf.history_window)
+        self.num_rounds = 0
+        self.downloads = dict((pid, deque(maxlen=windows[pid])) for pid in my_ids)
+        self.uploads = dict((pid, deque(maxlen=windows[pid])) for pid in my_ids)
+
+        # Same constructor arguments, and so the same rngs, as in process
+        self.agents = []
+        for pid in my_ids:
+            agent_class = conf.agent_classes[class_of[pid]]
+            self.agents.append(agent_class(
+                conf, pid, self.views[pid], up_bws[pid],
+                random.Random(derive_seed(seed, pid))))
+
+    def history(self, peer_id):
+        counts = self.local_counts.views.get(peer_id, self.piece_counts_view)
+        return AgentHistory(peer_id, RoundWindow(self.downloads[peer_id], self),
+                            RoundWindow(self.uploads[peer_id], self), counts)
+
+    def others(self, peer_id):
+        if peer_id in self.neighbors:
+            return list(self.neighbors[peer_id])
+        return [peer for peer in self.peer_info if peer.id != peer_id]
+
+    def update(self, completed, downloads, uploads):
+        """Apply last round's results, as sent by the sim"""
+        (to_ids, piece_ids, new_blocks) = ([], [], [])
+        for pid in self.my_ids:
+            ds = [Download(from_id, pid, piece, blocks)
+                  for (from_id, piece, blocks) in downloads.get(pid, [])]
+            for d in ds:
+                to_ids.append(pid)
+                piece_ids.append(d.piece)
+                new_blocks.append(d.blocks)
+            self.downloads[pid].append(ds)
+            self.uploads[pid].append([Upload(pid, to_id, bw)
+                                      for (to_id, bw) in uploads.get(pid, [])])
+        self.piece_state.add_blocks(to_ids, piece_ids, new_blocks)
+        for (pid, piece_id) in completed:
+            self.available[pid].add(piece_id)
+            self.piece_counts[piece_id] += 1
+            self.local_counts.completed(pid, piece_id)
+        self.num_rounds += 1
+
+    def requests(self, round, completed, downloads, uploads, neighbors):
+        if round > 0:
+            self.update(completed, downloads, uploads)
+        for (pid, ids) in neighbors.items():
+            self.neighbors[pid] = [self.peer_info_by_id[n] for n in ids]
+            self.local_counts.rebuild(pid, ids)
+        replies = []
+        for agent in self.agents:
+            agent.update_pieces(self.views[agent.id])
+            (rs, wall, cpu, error) = self.call(
+                agent.requests, self.others(agent.id), self.history(agent.id))
+            rs = [(r.requester_id, r.peer_id, r.piece_id, r.start) for r in rs]
+            replies.append((agent.id, rs, wall, cpu, error))
+        return replies
+
+    def uploads_for(self, requests):
+        replies = []
+        for agent in self.agents:
+            made = requests[agent.id]
+            if made is None:
+                replies.append((agent.id, None, 0.0, 0.0, None))
+                continue
+            made = [Request(requester_id, agent.id, piece_id, start)
+                    for (requester_id, piece_id, start) in made]
+            (us, wall, cpu, error) = self.call(
+                agent.uploads, made, self.others(agent.id), self.history(agent.id))
+            us = [(u.from_id, u.to_id, u.bw) for u in us]
+            replies.append((agent.id, us, wall, cpu, error))
+        return replies
+
+    def call(self, f, *args):
+        return call_agent(f, *args)
+
+
+def call_agent(f, *args):
+    """Returns (result, wall, cpu, error).  A crash gives an empty result"""
+    try:
+        (result, wall, cpu) = timed_call(f, *args)
+        check_types(result)
+        return (result, wall, cpu, None)
+    except Exception:
+        return ([], 0.0, 0.0, traceback.format_exc())
+
+
+def check_types(result):
+    """Only messages can be sent back to the sim"""
+    for m in result:
+        if not isinstance(m, (Request, Upload)):
+            raise TypeError("Agent returned a non-message object: %r" % (m,))
+
+
+def serve(conn, args):
+    """
+    Worker process main loop.  args are AgentWorker's.  The global random
+    module is seeded like the sim's, for agents that still use it.
+    """
+    random.seed(args[1])
+    worker = AgentWorker(*args)
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        if msg[0] == "requests":
+            conn.send(worker.requests(*msg[1:]))
+        elif msg[0] == "uploads":
+            conn.send(worker.uploads_for(msg[1]))
+        elif msg[0] == "close":
+            return
+
+
+# With a time budget, a worker is hung if it takes longer than
+# HANG_GRACE seconds plus HANG_FACTOR times its agents' budgets to reply
+HANG_FACTOR = 10
+HANG_GRACE = 1.0
+
+
+class AgentPool:
+    """
+    The sim's side: starts the workers, and turns each round's calls into
+    one message per worker.
+    initial_pieces: dict : peer_id -> [blocks / piece] or UniformPieces
+    up_bws: dict : peer_id -> upload bandwidth
+    conns: the pipe to each worker, None once it has been stopped
+    """
+    def __init__(self, conf, seed, peer_ids, initial_pieces, up_bws, workers):
+        workers = max(1, min(workers, len(peer_ids)))
+        self.owned = [peer_ids[k::workers] for k in range(workers)]
+        self.budget = conf.time_budget
+        self.conns = []
+        self.procs = []
+        for my_ids in self.owned:
+            (conn, child_conn) = multiprocessing.Pipe()
+            args = (conf, seed, peer_ids, my_ids, initial_pieces, up_bws)
+            proc = multiprocessing.Process(target=serve, args=(child_conn, args))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.procs.append(proc)
+
+    def timeout(self, k):
+        """Seconds worker k gets to reply, or None to wait for as long as it takes"""
+        if self.budget is None:
+            return None
+        return HANG_GRACE + HANG_FACTOR * self.budget * len(self.owned[k])
+
+    def exchange(self, messages):
+        """
+        Send one message to each worker, and collect the replies.  A worker
+        that dies or hangs is stopped, and its peers get empty replies.
+        """
+        start = clock()
+        for (conn, msg) in zip(self.conns, messages):
+            if conn is not None:
+                try:
+                    conn.send(msg)
+                except (BrokenPipeError, OSError):
+                    pass   # it died: recv() says so below
+        replies = []
+        for (k, conn) in enumerate(self.conns):
+            error = None
+            if conn is not None:
+                timeout = self.timeout(k)
+                try:
+                    if timeout is None or conn.poll(max(0.0, start + timeout - clock())):
+                        replies.extend(conn.recv())
+                        continue
+                    error = "didn't reply within %.1fs" % timeout
+                except EOFError:
+                    error = "died (exit code %s)" % self.procs[k].exitcode
+                error = self.stop(k, error)
+            replies.extend((pid, [], 0.0, 0.0, error) for pid in self.owned[k])
+        return replies
+
+    def stop(self, k, why):
+        """Stop worker k, which died or hung.  Returns the error for its peers"""
+        error = "Agent worker %d %s" % (self.procs[k].pid, why)
+        logging.warning("%s: stopped it, so peers %s make no requests or "
+                        "uploads from now on", error, ", ".join(self.owned[k]))
+        self.procs[k].terminate()
+        self.procs[k].join()
+        self.conns[k].close()
+        self.conns[k] = None
+        return error
+
+    def requests(self, round, completed, downloads, uploads, neighbors):
+        """
+        completed: [(peer_id, piece_id)] finished last round
+        downloads, uploads: last round's, dict : peer_id -> [Download / Upload]
+        neighbors: dict : peer_id -> [neighbor ids], for the peers whose
+        neighbors changed
+
+        Returns dict : peer_id -> ([Requests], wall, cpu, error)
+        """
+        messages = []
+        for my_ids in self.owned:
+            ds = dict((pid, [(d.from_id, d.piece, d.blocks)
+                             for d in downloads.get(pid, [])])
+                      for pid in my_ids)
+            us = dict((pid, [(u.to_id, u.bw) for u in uploads.get(pid, [])])
+                      for pid in my_ids)
+            ns = dict((pid, neighbors[pid]) for pid in my_ids if pid in neighbors)
+            messages.append(("requests", round, completed, ds, us, ns))
+        ans = dict()
+        for (pid, rs, wall, cpu, error) in self.exchange(messages):
+            rs = [Request(*r) for r in rs]
+            ans[pid] = (rs, wall, cpu, error)
+        return ans
+
+    def uploads(self, requests_to, skip=()):
+        """
+        requests_to: dict : peer_id -> [Requests made to that peer]
+        skip: ids of peers whose uploads() should not be called
+
+        Returns dict : peer_id -> ([Uploads], wall, cpu, error), with None
+        instead of the list for skipped peers.
+        """
+        messages = []
+        for my_ids in self.owned:
+            rs = dict()
+            for pid in my_ids:
+                if pid in skip:
+                    rs[pid] = None
+                else:
+                    rs[pid] = [(r.requester_id, r.piece_id, r.start)
+                               for r in requests_to[pid]]
+            messages.append(("uploads", rs))
+        ans = dict()
+        for (pid, us, wall, cpu, error) in self.exchange(messages):
+            if us is not None:
+                us = [Upload(*u) for u in us]
+            ans[pid] = (us, wall, cpu, error)
+        return ans
+
+    def close(self):
+        for conn in self.conns:
+            if conn is None:
+                continue
+            try:
+                conn.send(("close",))
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+        for proc in self.procs:
+            proc.join()
+
+
+class ThreadAgentPool:
+    """
+    Calls the sim's own agents on a pool of threads.  The agents see the
+    sim's live state (read-only views of it), which doesn't change during a
+    requests or an uploads phase.  requests() and uploads() are as AgentPool's.
+    others: function peer_id -> [PeerInfo the peer sees], the sim's own
+    """
+    def __init__(self, agents, others, history, piece_state, workers):
+        self.agents = agents
+        self.others = others
+        self.history = history
+        self.piece_state = piece_state
+        self.executor = ThreadPoolExecutor(max(1, workers))
+
+    def gather(self, calls):
+        """calls: [(peer_id, f, args)].  Returns dict : peer_id -> reply"""
+        futures = [(pid, self.executor.submit(call_agent, f, *args))
+                   for (pid, f, args) in calls]
+        return dict((pid, future.result()) for (pid, future) in futures)
+
+    def requests(self, round, completed, downloads, uploads, neighbors):
+        calls = []
+        for agent in self.agents:
+            agent.update_pieces(self.piece_state.pieces(agent.id))
+            calls.append((agent.id, agent.requests,
+                          (self.others(agent.id),
+                           self.history.peer_history(agent.id))))
+        return self.gather(calls)
+
+    def uploads(self, requests_to, skip=()):
+        calls = [(agent.id, agent.uploads,
+                  (requests_to[agent.id], self.others(agent.id),
+                   self.history.peer_history(agent.id)))
+                 for agent in self.agents if agent.id not in skip]
+        replies = self.gather(calls)
+        for pid in skip:
+            replies[pid] = (None, 0.0, 0.0, None)
+        return replies
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def free_threaded():
+    """Is this a python build without the GIL (or with it turned off)?"""
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+def resolve_isolation(isolation):
+    """'auto' is threads on a free-threaded build, processes otherwise"""
+    if isolation == "auto":
+        return "thread" if free_threaded() else "process"
+    return isolation
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+"""
+Memory / allocation benchmark for the message classes in messages.py.
+
+Compares the __slots__ messages with the old __dict__ based ones, first by
+allocating messages on their own, then by running a short 1000-peer
+simulation with each set of classes patched into the simulator and agents.
+
+    python benchmarks/bench_messages.py [--peers 1000] [--pieces 64] [--rounds 3]
+"""
+
+import contextlib
+import io
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import messages
+import sim
+
+
+class DictUpload:
+    def __init__(self, from_id, to_id, up_bw):
+        self.from_id = from_id
+        self.to_id = to_id
+        self.bw = up_bw
+
+
+class DictRequest:
+    def __init__(self, requester_id, peer_id, piece_id, start):
+        self.requester_id = requester_id
+        self.peer_id = peer_id
+        self.piece_id = piece_id
+        self.start = start
+
+
+class DictDownload:
+    def __init__(self, from_id, to_id, piece, blocks):
+        self.from_id = from_id
+        self.to_id = to_id
+        self.piece = piece
+        self.blocks = blocks
+
+
+class DictPeerInfo:
+    def __init__(self, id, available):
+        self.id = id
+        self.available_pieces = available
+
+
+SLOTTED = dict(Upload=messages.Upload, Request=messages.Request,
+               Download=messages.Download, PeerInfo=messages.PeerInfo)
+DICT_BASED = dict(Upload=DictUpload, Request=DictRequest,
+                  Download=DictDownload, PeerInfo=DictPeerInfo)
+
+
+@contextlib.contextmanager
+def patched_messages(classes):
+    """Swap the message classes in every loaded module that imported them"""
+    swapped = []
+    for module in list(sys.modules.values()):
+        for (name, cls) in classes.items():
+            current = getattr(module, name, None)
+            if current is SLOTTED[name] and cls is not current:
+                setattr(module, name, cls)
+                swapped.append((module, name, current))
+    try:
+        yield
+    finally:
+        for (module, name, cls) in swapped:
+            setattr(module, name, cls)
+
+
+def measure(f):
+    """Run f, return (seconds, peak traced bytes, bytes still allocated)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = f()
+    elapsed = time.perf_counter() - start
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return (elapsed, peak, current)
+
+
+def allocate(classes, n):
+    """Allocate n of each message, the way a round of requests/uploads would"""
+    Request, Upload, Download = classes["Request"], classes["Upload"], classes["Download"]
+    ids = ["AclaStd%d" % i for i in range(1000)]
+    kept = []
+    for i in range(n):
+        a, b = ids[i % 1000], ids[(i * 7) % 1000]
+        kept.append(Request(a, b, i % 256, 0))
+        kept.append(Upload(b, a, 4))
+        kept.append(Download(b, a, i % 256, 4))
+    return kept
+
+
+def run_swarm(peers, pieces, rounds):
+    names = sim.parse_agents(["AclaStd,%d" % (peers - peers // 100),
+                              "Seed,%d" % (peers // 100)])
+    options = sim.build_parser("").get_default_values()
+    options.num_pieces = pieces
+    options.max_round = rounds - 1
+    config = sim.make_config(options, names)
+
+    def f():
+        random.seed(0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return sim.Sim(config).run_sim_once()
+    return f
+
+
+def report(title, results):
+    print(title)
+    print("  %-10s %10s %14s %14s" % ("messages", "seconds", "peak (MB)", "retained (MB)"))
+    for (name, (elapsed, peak, current)) in results:
+        print("  %-10s %10.2f %14.1f %14.1f" % (
+            name, elapsed, peak / 2.0**20, current / 2.0**20))
+    (_, (_, slotted_peak, _)), (_, (_, dict_peak, _)) = results
+    print("  slotted peak is %.0f%% of dict-based\n" % (100.0 * slotted_peak / dict_peak))
+
+
+def main(args):
+    parser = OptionParser(usage="Usage:  %prog [options]")
+    parser.add_option("--peers", dest="peers", default=1000, type="int",
+                      help="Number of peers in the simulated swarm")
+    parser.add_option("--pieces", dest="pieces", default=64, type="int",
+                      help="Number of pieces in the file")
+    parser.add_option("--rounds", dest="rounds", default=3, type="int",
+                      help="Number of rounds to simulate")
+    parser.add_option("--messages", dest="messages", default=100000, type="int",
+                      help="Number of each message type to allocate")
+    (options, args) = parser.parse_args(args[1:])
+
+    logging.disable(logging.INFO)
+
+    results = [(name, measure(lambda: allocate(classes, options.messages)))
+               for (name, classes) in [("slotted", SLOTTED), ("dict", DICT_BASED)]]
+    report("Allocating %d requests, uploads and downloads" % options.messages,
+           results)
+
+    results = []
+    for (name, classes) in [("slotted", SLOTTED), ("dict", DICT_BASED)]:
+        with patched_messages(classes):
+            results.append((name, measure(run_swarm(
+                options.peers, options.pieces, options.rounds))))
+    report("%d-peer swarm, %d pieces, %d rounds" % (
+        options.peers, options.pieces, options.rounds), results)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
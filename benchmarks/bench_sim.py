@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+"""
+Benchmark suite for the simulator's hot paths.
+
+Runs a fixed set of scenarios with a fixed seed.  For each scenario it
+reports the time spent in every phase of run_sim_once (requests, uploads,
+update_peer_pieces, history.update, ...), rounds per second and peak
+traced memory.  It then compares the results with a stored JSON baseline,
+so that regressions show up.
+
+    python benchmarks/bench_sim.py                    # all scenarios
+    python benchmarks/bench_sim.py --scenarios default,100x256
+    python benchmarks/bench_sim.py --save-baseline benchmarks/baseline.json
+
+Timings depend on the machine: regenerate the baseline with
+--save-baseline when moving to another one.  Exits with status 1 if any
+scenario regressed by more than --threshold.
+"""
+
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import tracemalloc
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sim
+from stats import Stats
+from timing import PhaseTimer, clock
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# name -> (agents, option overrides).  Round limits keep the big ones short.
+SCENARIOS = [
+    ("default", (["Dummy,2", "Seed"], dict())),
+    ("100x256", (["AclaStd,95", "Seed,5"],
+                 dict(num_pieces=256, max_round=20))),
+    ("1000x1024", (["AclaStd,990", "Seed,10"],
+                   dict(num_pieces=1024, max_round=3))),
+    ("seed-heavy", (["AclaStd,50", "Seed,50"],
+                    dict(num_pieces=128, max_round=30))),
+    ("seed-starved", (["AclaStd,100", "Seed,1"],
+                      dict(num_pieces=64, min_up_bw=2, max_up_bw=4,
+                           max_round=30))),
+]
+
+
+def make_sim(agents, overrides, timer=None):
+    options = sim.build_parser("").get_default_values()
+    for (dest, value) in overrides.items():
+        setattr(options, dest, value)
+    config = sim.make_config(options, sim.parse_agents(agents))
+    s = sim.Sim(config, timer)
+    s.peer_ids = sim.peer_ids_for(config.agent_class_names)
+    return s
+
+
+def run_once(s, seed):
+    """Run one simulation quietly, and time the stats on its history"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        history = s.run_sim_once(seed)
+    start = clock()
+    Stats.uploaded_blocks(s.peer_ids, history)
+    Stats.completion_rounds(s.peer_ids, history)
+    if s.timer is not None:
+        s.timer.add("stats", clock() - start)
+    return history
+
+
+def run_scenario(agents, overrides, seed, memory):
+    timer = PhaseTimer()
+    start = clock()
+    history = run_once(make_sim(agents, overrides, timer), seed)
+    elapsed = clock() - start
+    rounds = history.last_round() + 1
+    result = dict(rounds=rounds,
+                  seconds=elapsed,
+                  rounds_per_sec=rounds / elapsed,
+                  phases=timer.totals)
+
+    if memory:
+        # A separate run: tracemalloc slows everything down
+        del history
+        tracemalloc.start()
+        run_once(make_sim(agents, overrides), seed)
+        result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2.0**20
+        tracemalloc.stop()
+    return result
+
+
+def compare(name, result, base, threshold):
+    """Return a list of regression messages for one scenario"""
+    problems = []
+    if base["rounds"] != result["rounds"]:
+        problems.append("%s: ran %d rounds, baseline ran %d (results changed?)" % (
+            name, result["rounds"], base["rounds"]))
+    slower = base["rounds_per_sec"] / result["rounds_per_sec"] - 1
+    if slower > threshold:
+        problems.append("%s: %.0f%% fewer rounds/sec (%.2f vs %.2f)" % (
+            name, 100 * (1 - 1 / (1 + slower)), result["rounds_per_sec"],
+            base["rounds_per_sec"]))
+    if "peak_mb" in result and "peak_mb" in base:
+        bigger = result["peak_mb"] / base["peak_mb"] - 1
+        if bigger > threshold:
+            problems.append("%s: %.0f%% more peak memory (%.2f vs %.2f MB)" % (
+                name, 100 * bigger, result["peak_mb"], base["peak_mb"]))
+    return problems
+
+
+def pretty(name, result, base):
+    lines = ["== %s: %d rounds in %.2fs, %.2f rounds/sec%s" % (
+        name, result["rounds"], result["seconds"], result["rounds_per_sec"],
+        ", peak %.2f MB" % result["peak_mb"] if "peak_mb" in result else "")]
+    if base:
+        lines.append("   baseline: %.2f rounds/sec%s" % (
+            base["rounds_per_sec"],
+            ", peak %.2f MB" % base["peak_mb"] if "peak_mb" in base else ""))
+    for (phase, seconds) in result["phases"].items():
+        lines.append("   %-20s %9.3fs  %5.1f%%" % (
+            phase, seconds, 100.0 * seconds / result["seconds"]))
+    return "\n".join(lines)
+
+
+def main(args):
+    names = [name for (name, _) in SCENARIOS]
+    parser = OptionParser(usage="Usage:  %prog [options]")
+    parser.add_option("--scenarios", dest="scenarios", default=",".join(names),
+                      help="Comma separated scenarios to run, from: %s" % ", ".join(names))
+    parser.add_option("--seed", dest="seed", default=1, type="int",
+                      help="Seed for every scenario")
+    parser.add_option("--no-memory", dest="memory", default=True,
+                      action="store_false",
+                      help="Skip the (slow) peak memory measurement")
+    parser.add_option("--baseline", dest="baseline", default=BASELINE,
+                      help="JSON baseline to compare against")
+    parser.add_option("--save-baseline", dest="save_baseline", default=None,
+                      help="Write the results to this file as the new baseline")
+    parser.add_option("--threshold", dest="threshold", default=0.2, type="float",
+                      help="Relative slowdown / memory growth counted as a "
+                      "regression (default 0.2)")
+    (options, args) = parser.parse_args(args[1:])
+
+    scenarios = dict(SCENARIOS)
+    chosen = options.scenarios.split(",")
+    for name in chosen:
+        if name not in scenarios:
+            parser.error("Unknown scenario: %s" % name)
+
+    logging.disable(logging.INFO)
+
+    baseline = {}
+    if options.baseline and os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    problems = []
+    for name in chosen:
+        (agents, overrides) = scenarios[name]
+        result = run_scenario(agents, overrides, options.seed, options.memory)
+        results[name] = result
+        print(pretty(name, result, baseline.get(name)))
+        if name in baseline:
+            problems.extend(compare(name, result, baseline[name], options.threshold))
+        sys.stdout.flush()
+
+    if options.save_baseline:
+        with open(options.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("\nSaved baseline to %s" % options.save_baseline)
+
+    if problems:
+        print("\nREGRESSIONS:")
+        print("\n".join(problems))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+
+"""
+Checkpoints of a running simulation (sim.py --checkpoint / --resume).
+
+A checkpoint is two files, each a header followed by zlib compressed
+pickled records:
+
+  rounds: in FILE, (first round, [(downloads, uploads) for each round]).
+          The history rounds added since the previous checkpoint, in peer
+          order, as tuples: downloads [(from_id, piece, blocks)] to each
+          peer and uploads [(to_id, bw)] from each peer.
+  state:  in FILE.state, its only record: everything else needed to carry
+          on: the round to run next, the peers (with their rngs), the
+          piece state, available pieces, piece counts, who is done, the
+          topology, and the sim's and the random module's rngs.
+
+The history is append-only, so each checkpoint only appends its new
+rounds to FILE, and replaces FILE.state with the current state (written to
+a temporary file first, then renamed over it).  So neither file grows with
+the number of checkpoints beyond the history itself.  The state is pickled
+between rounds; compressing and writing happen on a background thread, so
+rounds don't wait for the disk.  If the run dies part way through writing,
+FILE.state is still the previous checkpoint's, and any rounds after it in
+FILE are ignored.
+"""
+
+import logging
+import os
+import pickle
+import queue
+import random
+import struct
+import threading
+import zlib
+
+from messages import Upload, Download
+from history import make_history
+
+MAGIC = b"BTSIMCK4"
+RECORD = struct.Struct(">BI")   # kind, compressed length
+ROUNDS = 1
+STATE = 2
+
+# Must match between the checkpoint and a resumed run
+SAME_CONFIG = ["agent_class_names", "num_pieces", "blocks_per_piece",
+               "topology", "degree"]
+
+
+class Checkpointer:
+    """
+    Writes checkpoints to path and path.state.
+    rounds_written: how many history rounds path already has
+    """
+    def __init__(self, path, rounds_written=0):
+        self.path = path
+        self.rounds_written = rounds_written
+        if rounds_written == 0:
+            self.f = open(path, "wb")
+            self.f.write(MAGIC)
+        else:
+            self.f = open(path, "ab")
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.write_records, daemon=True)
+        self.thread.start()
+
+    def write_records(self):
+        while True:
+            records = self.queue.get()
+            if records is None:
+                return
+            try:
+                (rounds, state) = records
+                write_record(self.f, ROUNDS, rounds)
+                self.f.flush()
+                os.fsync(self.f.fileno())
+                # Only replace the last state once its rounds are on disk
+                tmp = state_path(self.path) + ".tmp"
+                with open(tmp, "wb") as f:
+                    f.write(MAGIC)
+                    write_record(f, STATE, state)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, state_path(self.path))
+            except Exception as e:
+                self.error = e
+                logging.error("Writing checkpoint %s failed: %s", self.path, e)
+                return
+
+    def save(self, sim, round, peers, piece_state, history, available,
+             piece_counts, unfinished, topology):
+        """
+        Checkpoint the simulation between rounds: round is the next round to run.
+        Pickles right away, so the simulation can carry on changing its state.
+        """
+        if self.error is not None:
+            raise self.error
+        rounds = [round_tuples(history, r)
+                  for r in range(self.rounds_written, round)]
+        state = dict(round=round,
+                     config=dict((k, getattr(sim.config, k)) for k in SAME_CONFIG),
+                     peers=peers,
+                     piece_state=piece_state,
+                     available=available,
+                     piece_counts=piece_counts,
+                     unfinished=unfinished,
+                     topology=topology,
+                     round_done=history.round_done,
+                     up_bws_state=sim.up_bws_state,
+                     sim_rng=sim.rng.getstate(),
+                     random_state=random.getstate())
+        protocol = pickle.HIGHEST_PROTOCOL
+        self.queue.put((pickle.dumps((self.rounds_written, rounds), protocol),
+                        pickle.dumps(state, protocol)))
+        self.rounds_written = round
+        logging.info("Checkpointed round %d to %s", round, self.path)
+
+    def close(self):
+        """Wait for the pending checkpoints to be written"""
+        self.queue.put(None)
+        self.thread.join()
+        self.f.close()
+        if self.error is not None:
+            raise self.error
+
+
+def state_path(path):
+    return path + ".state"
+
+
+def write_record(f, kind, data):
+    data = zlib.compress(data)
+    f.write(RECORD.pack(kind, len(data)))
+    f.write(data)
+
+
+def read_record(f):
+    """The next (kind, record) in f, or None at the end or an unfinished write"""
+    header = f.read(RECORD.size)
+    if len(header) < RECORD.size:
+        return None
+    (kind, length) = RECORD.unpack(header)
+    data = f.read(length)
+    if len(data) < length:
+        return None
+    return (kind, pickle.loads(zlib.decompress(data)))
+
+
+def round_tuples(history, r):
+    """One round of the history, as (downloads, uploads) tuples in peer order"""
+    downloads = []
+    uploads = []
+    for pid in history.peer_ids:
+        h = history.peer_history(pid)
+        downloads.append([(d.from_id, d.piece, d.blocks) for d in h.downloads[r]])
+        uploads.append([(u.to_id, u.bw) for u in h.uploads[r]])
+    return (downloads, uploads)
+
+
+def read_records(path):
+    """
+    Returns (rounds, state, end): the history rounds up to the checkpointed
+    round, the state, and the offset in path just after its last complete
+    rounds record.
+    """
+    with open(state_path(path), "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a simulation checkpoint" % state_path(path))
+        record = read_record(f)
+    if record is None or record[0] != STATE:
+        raise ValueError("%s has no complete checkpoint" % state_path(path))
+    state = record[1]
+
+    rounds = []
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a simulation checkpoint" % path)
+        end = f.tell()
+        while True:
+            record = read_record(f)
+            if record is None:
+                break
+            (first, new_rounds) = record[1]
+            del rounds[first:]
+            rounds.extend(new_rounds)
+            end = f.tell()
+    if len(rounds) < state["round"]:
+        raise ValueError("%s is missing rounds of its checkpoint" % path)
+    return (rounds[:state["round"]], state, end)
+
+
+def restore(path, sim):
+    """
+    Load the checkpoint in path into sim (its rngs and bandwidths), and
+    the random module.  Returns (round, peers, piece_state, history,
+    available, piece_counts, unfinished, topology).  Also truncates any
+    unfinished write off the end of path, so it can be checkpointed to again.
+    """
+    conf = sim.config
+    (rounds, state, end) = read_records(path)
+    for key in SAME_CONFIG:
+        if state["config"][key] != getattr(conf, key):
+            raise ValueError("Checkpoint %s has %s=%s, not %s" % (
+                path, key, state["config"][key], getattr(conf, key)))
+    with open(path, "r+b") as f:
+        f.truncate(end)
+
+    peers = state["peers"]
+    for p in peers:
+        p.conf = conf
+    peer_ids = [p.id for p in peers]
+    sim.up_bws_state = state["up_bws_state"]
+    sim.rng.setstate(state["sim_rng"])
+    random.setstate(state["random_state"])
+
+    upload_rates = dict((pid, sim.up_bws_state[pid]) for pid in peer_ids)
+    history = make_history(conf.history, peer_ids, upload_rates)
+    for (downloads, uploads) in rounds:
+        dls = dict((pid, [Download(from_id, pid, piece, blocks)
+                          for (from_id, piece, blocks) in ds])
+                   for (pid, ds) in zip(peer_ids, downloads))
+        ups = dict((pid, [Upload(pid, to_id, bw) for (to_id, bw) in us])
+                   for (pid, us) in zip(peer_ids, uploads))
+        history.update(dls, ups)
+    history.round_done.update(state["round_done"])
+
+    return (state["round"], peers, state["piece_state"], history,
+            state["available"], state["piece_counts"], state["unfinished"],
+            state["topology"])
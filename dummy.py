@@ -3,14 +3,19 @@
 # This is a dummy peer that just illustrates the available information your peers 
 # have available.  The setup script will copy it to create the versions you edit
 
-import random
 import logging
 
 from messages import Upload, Request
 from util import even_split
 from peer import Peer
+from pieceset import PieceSet
 
 class Dummy(Peer):
+    # Uses only history.current_round()
+    history_window = 0
+    idle_when_done = True
+    idle_without_requests = True
+
     def post_init(self):
         print("post_init(): %s here!" % self.id)
         ##################################################################################
@@ -34,28 +39,29 @@ class Dummy(Peer):
         #Calculate the pieces you still need
         needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
         needed_pieces = list(filter(needed, list(range(len(self.pieces)))))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
+        np_set = PieceSet(needed_pieces)  # bitsets intersect in one AND
 
 
-        logging.debug("%s here: still need pieces %s" % (
-            self.id, needed_pieces))
+        logging.debug("%s here: still need pieces %s",
+                      self.id, needed_pieces)
 
         #This code shows you what you have access to in peers and history
         #You won't need it in your final solution, but may want to uncomment it
         #and see what it does to help you get started
         """
-        logging.debug("%s still here. Here are some peers:" % self.id)
-        for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
-
-        logging.debug("And look, I have my entire history available too:")
-        logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("%s still here. Here are some peers:", self.id)
+            for p in peers:
+                logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
+
+            logging.debug("And look, I have my entire history available too:")
+            logging.debug("look at the AgentHistory class in history.py for details")
+            logging.debug("%s", history)
         """
 
         requests = []   # We'll put all the things we want here
         # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
+        self.rng.shuffle(needed_pieces)
 
         # count frequencies of all pieces that the other peers have
         # this will be useful for implementing rarest first
@@ -75,13 +81,15 @@ class Dummy(Peer):
         # This code asks for pieces at random, you need to adapt it to rarest first #
         #############################################################################
         for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
+            available = peer.available_pieces
+            if available.isdisjoint(np_set):
+                continue
+            isect = available & np_set
             n = min(self.max_requests, len(isect))
             # More symmetry breaking -- ask for random pieces.
             # You could try fancier piece-requesting strategies
             # to avoid getting the same thing from multiple peers at a time.
-            for piece_id in random.sample(isect, int(n)):
+            for piece_id in self.rng.sample(sorted(isect), int(n)):
                 # aha! The peer has this piece! Request it.
                 # which part of the piece do we need next?
                 # (must get the next-needed blocks in order)
@@ -111,8 +119,7 @@ class Dummy(Peer):
         ##############################################################################
 
         round = history.current_round()
-        logging.debug("%s again.  It's round %d." % (
-            self.id, round))
+        logging.debug("%s again.  It's round %d.", self.id, round)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
@@ -129,7 +136,7 @@ class Dummy(Peer):
             # The dummy client picks a single peer at random to unchoke.           #
             # You should decide a set of peers to unchoke accoring to the protocol #
             ########################################################################
-            request = random.choice(requests)
+            request = self.rng.choice(requests)
             chosen = [request.requester_id]
 
 
@@ -1,7 +1,15 @@
 #!/usr/bin/python
 
 import copy
+import json
 import pprint
+import struct
+import sys
+from array import array
+from collections import deque
+from collections.abc import Sequence
+
+from messages import Upload, Download
 
 
 class AgentHistory:
@@ -14,14 +22,20 @@ class AgentHistory:
     history.uploads: [[Upload objects for round]]  (one sublist for each round)
          All the downloads _from_ this agent.
 
+    history.piece_counts: read-only list, one entry per piece
+         How many peers in the swarm (including this one) have finished
+         each piece, as of the start of the current round.  With a bounded
+         --topology, only this peer and its neighbors are counted.
+
     """
-    def __init__(self, peer_id, downloads, uploads):
+    def __init__(self, peer_id, downloads, uploads, piece_counts=None):
         """
         Pull out just the info for peer_id.
         """
         self.uploads = uploads
         self.downloads = downloads
         self.peer_id = peer_id
+        self.piece_counts = piece_counts
 
     def last_round(self):
         return len(self.downloads)-1
@@ -55,6 +69,13 @@ class History:
         self.downloads = dict((pid, []) for pid in peer_ids)
         self.uploads = dict((pid, []) for pid in peer_ids)
 
+        # Read-only view of the sim's count of peers having each piece.
+        # Set by the sim, handed to the agents in their AgentHistory.
+        self.piece_counts = None
+        # With a bounded topology, dict : peer_id -> read-only view of the
+        # counts over the peer and its neighbors, handed out instead.
+        self.neighborhood_counts = None
+
     def update(self, dls, ups):
         """
         dls: dict : peer_id -> [downloads] -- downloads for this round
@@ -72,7 +93,24 @@ class History:
             self.round_done[peer_id] = round
 
     def peer_history(self, peer_id):
-        return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id])
+        counts = self.piece_counts
+        if self.neighborhood_counts is not None:
+            counts = self.neighborhood_counts[peer_id]
+        return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id],
+                            counts)
+
+    def close(self):
+        """Called once the simulation is over"""
+        pass
+
+    def uploaded_totals(self):
+        """dict : peer_id -> total blocks uploaded so far"""
+        uploaded = dict((peer_id, 0) for peer_id in self.peer_ids)
+        for peer_id in self.peer_ids:
+            for ds in self.downloads[peer_id]:
+                for download in ds:
+                    uploaded[download.from_id] += download.blocks
+        return uploaded
 
     def last_round(self):
         """index of the last completed round"""
@@ -80,19 +118,12 @@ class History:
         return len(self.downloads[p])-1
 
     def pretty_for_round(self, r):
-        s = "\nRound %s:\n" % r
-        for peer_id in self.peer_ids:
-            ds = self.downloads[peer_id][r]
-            stringify = lambda d: "%s downloaded %d blocks of piece %d from %s\n" % (
-                peer_id, d.blocks, d.piece, d.from_id)
-            s += "".join(map(stringify, ds))
-        return s
+        return pretty_round(r, self.peer_ids,
+                            dict((pid, self.downloads[pid][r]) for pid in self.peer_ids))
 
     def pretty(self):
-        s = "History\n"
-        for r in range(self.last_round()+1):
-            s += self.pretty_for_round(r)
-        return s
+        return "History\n" + "".join(self.pretty_for_round(r)
+                                      for r in range(self.last_round()+1))
 
     def __repr__(self):
         return """History(
@@ -102,3 +133,343 @@ downloads=%s
     pprint.pformat(self.uploads),
     pprint.pformat(self.downloads))
 
+
+def pretty_round(r, peer_ids, downloads):
+    """downloads: dict : peer_id -> [Downloads to that peer in round r]"""
+    lines = ["\nRound %s:\n" % r]
+    for peer_id in peer_ids:
+        stringify = lambda d: "%s downloaded %d blocks of piece %d from %s\n" % (
+            peer_id, d.blocks, d.piece, d.from_id)
+        lines.extend(map(stringify, downloads[peer_id]))
+    return "".join(lines)
+
+
+class _RoundsView(Sequence):
+    """
+    Read-only list of rounds for one peer of a ColumnarHistory: view[r] is
+    the list of Download (or Upload) objects for round r, built on demand.
+    """
+    def __init__(self, table, peer_index):
+        self.table = table
+        self.peer_index = peer_index
+
+    def __len__(self):
+        return self.table.num_rounds
+
+    def __getitem__(self, r):
+        if isinstance(r, slice):
+            return [self[i] for i in range(*r.indices(len(self)))]
+        if r < 0:
+            r += len(self)
+        if not 0 <= r < len(self):
+            raise IndexError("round %d out of range" % r)
+        return self.table.rows(r, self.peer_index)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class _Table:
+    """
+    Parallel typed columns, one entry per message.  Rows are appended round
+    by round and, within a round, peer by peer, so
+        offsets[r*num_peers + i] : offsets[r*num_peers + i + 1]
+    are the rows for peer i in round r.
+    """
+    def __init__(self, peer_ids, make_row, fields):
+        self.peer_ids = peer_ids
+        self.make_row = make_row
+        self.fields = fields
+        self.columns = [array('i') for f in fields]
+        self.offsets = array('q', [0])
+        self.num_rounds = 0
+
+    def append_round(self, rows_by_peer):
+        """rows_by_peer: one list of tuples of ints per peer, in peer order"""
+        columns = self.columns
+        for rows in rows_by_peer:
+            for row in rows:
+                for (column, value) in zip(columns, row):
+                    column.append(value)
+            self.offsets.append(len(columns[0]))
+        self.num_rounds += 1
+
+    def rows(self, r, peer_index):
+        k = r * len(self.peer_ids) + peer_index
+        (start, end) = (self.offsets[k], self.offsets[k + 1])
+        return [self.make_row(*[column[i] for column in self.columns])
+                for i in range(start, end)]
+
+    def round_slice(self, r):
+        """(start, end) rows of round r, for all peers"""
+        n = len(self.peer_ids)
+        return (self.offsets[r * n], self.offsets[(r + 1) * n])
+
+
+class ColumnarHistory(History):
+    """
+    History kept in typed arrays instead of lists of message objects.
+
+    downloads columns: from, to, piece, blocks
+    uploads columns:   from, to, bw
+    Peers are stored by their index in peer_ids.  Both tables are indexed
+    by (round, peer), so history.downloads[peer_id][round] (and so an
+    AgentHistory) is a constant time lookup, and the per-peer upload totals
+    used by Stats are kept up to date as rounds are added.
+    Upload bandwidths must be ints.
+    """
+    def __init__(self, peer_ids, upload_rates):
+        History.__init__(self, peer_ids, upload_rates)
+        self.peer_index = dict((pid, i) for (i, pid) in enumerate(self.peer_ids))
+
+        ids = self.peer_ids
+        self.download_table = _Table(
+            ids, lambda f, t, piece, blocks: Download(ids[f], ids[t], piece, blocks),
+            ("from", "to", "piece", "blocks"))
+        self.upload_table = _Table(
+            ids, lambda f, t, bw: Upload(ids[f], ids[t], bw),
+            ("from", "to", "bw"))
+        self.uploaded = array('q', [0] * len(ids))
+
+        self.downloads = dict((pid, _RoundsView(self.download_table, i))
+                              for (pid, i) in self.peer_index.items())
+        self.uploads = dict((pid, _RoundsView(self.upload_table, i))
+                            for (pid, i) in self.peer_index.items())
+
+    def update(self, dls, ups):
+        index = self.peer_index
+        uploaded = self.uploaded
+
+        dl_rows = []
+        ul_rows = []
+        for pid in self.peer_ids:
+            rows = []
+            for d in dls[pid]:
+                f = index[d.from_id]
+                rows.append((f, index[d.to_id], d.piece, d.blocks))
+                uploaded[f] += d.blocks
+            dl_rows.append(rows)
+            ul_rows.append([(index[u.from_id], index[u.to_id], u.bw)
+                            for u in ups[pid]])
+        self.download_table.append_round(dl_rows)
+        self.upload_table.append_round(ul_rows)
+
+    def uploaded_totals(self):
+        return dict((pid, self.uploaded[i]) for (pid, i) in self.peer_index.items())
+
+    def last_round(self):
+        return self.download_table.num_rounds - 1
+
+
+HISTORY_MAGIC = b"BTSIMHS1"
+COUNTS = struct.Struct(">II")
+
+
+class HistoryWriter:
+    """
+    Appends rounds to a history file: a header (magic, then the length of a
+    JSON dict with the peer ids and the byte order), then for every round
+    the number of downloads and uploads and their columns as raw int
+    arrays: downloads from, to, piece, blocks and uploads from, to, bw.
+    Peers are stored by their index in peer_ids.
+    """
+    def __init__(self, path, peer_ids):
+        self.path = path
+        self.index = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+        self.f = open(path, "wb")
+        header = json.dumps(dict(peer_ids=peer_ids,
+                                 byteorder=sys.byteorder)).encode()
+        self.f.write(HISTORY_MAGIC)
+        self.f.write(struct.pack(">I", len(header)))
+        self.f.write(header)
+
+    def write_round(self, dls, ups):
+        index = self.index
+        dl_columns = [array('i') for i in range(4)]
+        ul_columns = [array('i') for i in range(3)]
+        for pid in index:
+            for d in dls[pid]:
+                for (column, value) in zip(dl_columns, (
+                        index[d.from_id], index[d.to_id], d.piece, d.blocks)):
+                    column.append(value)
+            for u in ups[pid]:
+                for (column, value) in zip(ul_columns, (
+                        index[u.from_id], index[u.to_id], u.bw)):
+                    column.append(value)
+        self.f.write(COUNTS.pack(len(dl_columns[0]), len(ul_columns[0])))
+        for column in dl_columns + ul_columns:
+            self.f.write(column.tobytes())
+
+    def flush(self):
+        if not self.f.closed:
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def read_history(path):
+    """
+    Read a history file written by a StreamingHistory.  Yields, for each
+    round, (downloads, uploads): dicts : peer_id -> [Download / Upload].
+    """
+    with open(path, "rb") as f:
+        if f.read(len(HISTORY_MAGIC)) != HISTORY_MAGIC:
+            raise ValueError("%s is not a history file" % path)
+        (length,) = struct.unpack(">I", f.read(4))
+        header = json.loads(f.read(length).decode())
+        ids = header["peer_ids"]
+        swap = header["byteorder"] != sys.byteorder
+
+        def column(n):
+            a = array('i')
+            a.frombytes(f.read(n * a.itemsize))
+            if swap:
+                a.byteswap()
+            return a
+
+        while True:
+            counts = f.read(COUNTS.size)
+            if len(counts) < COUNTS.size:
+                return
+            (num_downloads, num_uploads) = COUNTS.unpack(counts)
+            dl_columns = [column(num_downloads) for i in range(4)]
+            ul_columns = [column(num_uploads) for i in range(3)]
+            downloads = dict((pid, []) for pid in ids)
+            uploads = dict((pid, []) for pid in ids)
+            for (f_, t, piece, blocks) in zip(*dl_columns):
+                downloads[ids[t]].append(Download(ids[f_], ids[t], piece, blocks))
+            for (f_, t, bw) in zip(*ul_columns):
+                uploads[ids[f_]].append(Upload(ids[f_], ids[t], bw))
+            yield (downloads, uploads)
+
+
+class RoundWindow(Sequence):
+    """
+    One peer's rounds of downloads (or uploads) in a StreamingHistory.  It
+    has an entry for every round so far, but only the last few rounds are
+    still in memory: looking further back raises an IndexError.
+    history: anything with a num_rounds attribute
+    """
+    def __init__(self, recent, history):
+        self.recent = recent     # deque of the last rounds
+        self.history = history
+
+    def __len__(self):
+        return self.history.num_rounds
+
+    def __getitem__(self, r):
+        if isinstance(r, slice):
+            return [self[i] for i in range(*r.indices(len(self)))]
+        n = len(self)
+        if r < 0:
+            r += n
+        if not 0 <= r < n:
+            raise IndexError("round %d out of range" % r)
+        back = n - r
+        if back > len(self.recent):
+            raise IndexError("round %d is no longer in memory: only the last %d "
+                             "rounds are kept" % (r, len(self.recent)))
+        return self.recent[-back]
+
+    def __repr__(self):
+        return "<last %d of %d rounds: %r>" % (
+            len(self.recent), len(self), list(self.recent))
+
+
+class StreamingHistory(History):
+    """
+    History that keeps only the last few rounds in memory, and writes
+    every round to a history file (see HistoryWriter) as it happens, if
+    given a path.  window is the number of rounds to keep, either for every
+    peer or as a dict : peer_id -> rounds (see agent_windows).  A window of
+    None keeps every round.  The per-peer upload totals and the completion rounds
+    are kept up to date as rounds are added, so memory use doesn't grow
+    with the number of rounds.  read_history() reads the file back.
+    """
+    def __init__(self, peer_ids, upload_rates, window=2, path=None):
+        History.__init__(self, peer_ids, upload_rates)
+        self.window = window
+        self.path = path
+        self.num_rounds = 0
+        if not isinstance(window, dict):
+            window = dict((pid, window) for pid in self.peer_ids)
+        self.recent_downloads = dict((pid, deque(maxlen=window[pid]))
+                                     for pid in self.peer_ids)
+        self.recent_uploads = dict((pid, deque(maxlen=window[pid]))
+                                   for pid in self.peer_ids)
+        self.downloads = dict((pid, RoundWindow(self.recent_downloads[pid], self))
+                              for pid in self.peer_ids)
+        self.uploads = dict((pid, RoundWindow(self.recent_uploads[pid], self))
+                            for pid in self.peer_ids)
+        self.uploaded = dict((pid, 0) for pid in self.peer_ids)
+        self.writer = HistoryWriter(path, self.peer_ids) if path else None
+
+    def update(self, dls, ups):
+        uploaded = self.uploaded
+        for pid in self.peer_ids:
+            self.recent_downloads[pid].append(dls[pid])
+            self.recent_uploads[pid].append(ups[pid])
+            for d in dls[pid]:
+                uploaded[d.from_id] += d.blocks
+        self.num_rounds += 1
+        if self.writer is not None:
+            self.writer.write_round(dls, ups)
+
+    def uploaded_totals(self):
+        return dict(self.uploaded)
+
+    def last_round(self):
+        return self.num_rounds - 1
+
+    def pretty(self):
+        if self.writer is None:
+            return "History\n(not kept: old rounds were dropped from memory)\n"
+        self.writer.flush()
+        return "History\n" + "".join(
+            pretty_round(r, self.peer_ids, downloads)
+            for (r, (downloads, uploads)) in enumerate(read_history(self.path)))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+HISTORIES = {"list": History,
+             "columnar": ColumnarHistory,
+             "stream": StreamingHistory}
+
+
+def agent_windows(peer_ids, agent_classes, window=None):
+    """
+    agent_classes: the class of each peer, in peer_ids order
+
+    Returns dict : peer_id -> rounds of history to keep in memory for that
+    peer: what its class declares in its history_window (None for every
+    round).  window, if given, is used instead for the classes that don't
+    declare one, and raises the ones that declare fewer rounds; it never
+    cuts a class below what it says it needs.
+    """
+    windows = dict()
+    for (pid, agent_class) in zip(peer_ids, agent_classes):
+        declared = getattr(agent_class, "history_window", None)
+        if window is None:
+            windows[pid] = declared
+        elif declared is None:
+            windows[pid] = window
+        else:
+            windows[pid] = max(window, declared)
+    return windows
+
+
+def make_history(kind, peer_ids, upload_rates, window=None, path=None):
+    """
+    kind: one of the keys of HISTORIES
+    window, path: for a StreamingHistory, the rounds to keep in memory (see
+    StreamingHistory) and the file to write every round to (or None)
+    """
+    if kind not in HISTORIES:
+        raise ValueError("Unknown history kind: %s" % kind)
+    if kind == "stream":
+        return StreamingHistory(peer_ids, upload_rates, window, path)
+    return HISTORIES[kind](peer_ids, upload_rates)
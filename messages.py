@@ -1,6 +1,11 @@
 #!/usr/bin/python
 
+# Millions of messages are created in a run and all of them are kept in the
+# History, so they use __slots__ instead of a per-instance __dict__.
+
 class Upload:
+    __slots__ = ("from_id", "to_id", "bw")
+
     def __init__(self, from_id, to_id, up_bw):
         self.from_id = from_id
         self.to_id = to_id
@@ -11,6 +16,8 @@ class Upload:
             self.from_id, self.to_id, self.bw)
 
 class Request:
+    __slots__ = ("requester_id", "peer_id", "piece_id", "start")
+
     def __init__(self, requester_id, peer_id, piece_id, start):
         self.requester_id = requester_id
         self.peer_id = peer_id   # peer data is requested from
@@ -25,6 +32,8 @@ class Download:
     """ Not actually a message--just used for accounting and history tracking of
      what is actually downloaded.
     """
+    __slots__ = ("from_id", "to_id", "piece", "blocks")
+
     def __init__(self, from_id, to_id, piece, blocks):
         self.from_id = from_id  # who did the agent download from?
         self.to_id = to_id      # Who downloaded?
@@ -42,10 +51,19 @@ class PeerInfo:
     """
     Only passing peer ids and the pieces they have available to each agent.
     This prevents them from accidentally messing up the state of other agents.
+
+    available: the sim's MutablePieceSet for the peer.  available_pieces is
+    a read-only PieceSet snapshot of it.
     """
+    __slots__ = ("id", "available")
+
     def __init__(self, id, available):
         self.id = id
-        self.available_pieces = available
+        self.available = available
+
+    @property
+    def available_pieces(self):
+        return self.available.frozen()
 
     def __repr__(self):
         return "PeerInfo(id=%s)" % self.id
@@ -5,18 +5,40 @@ from messages import Upload, Request
 from util import even_split
 
 class Peer:
-    def __init__(self, config, id, init_pieces, up_bandwidth):
+    # How many of the latest rounds of history requests() and uploads() look
+    # at, None for all of them.  With --history stream only that many rounds
+    # are kept in memory for the agent.
+    history_window = None
+
+    # Promises that let the event-driven engine (--engine event) skip calls.
+    # idle_when_done: once this peer has every piece, requests() returns []
+    # and changes nothing (not even its rng).
+    # idle_without_requests: uploads() with no requests returns [] and
+    # changes nothing.
+    # Use wake_at() to be called in a round anyway.
+    idle_when_done = False
+    idle_without_requests = False
+
+    def __init__(self, config, id, init_pieces, up_bandwidth, rng=None):
         self.conf = config
         self.id = id
-        self.pieces = init_pieces[:]
+        # A read-only view of the sim's state, so there is no need to copy it
+        self.pieces = init_pieces
         # bandwidth measured in blocks-per-time-period
         self.up_bw = up_bandwidth
 
+        # This peer's own random.Random.  Use it instead of the random
+        # module, so that a seeded simulation is reproducible.
+        self.rng = rng if rng is not None else random.Random()
+
         # This is an upper bound on the number of requests to send to
         # each peer -- they can't possibly handle more than this in one round
         self.max_requests = self.conf.max_up_bw // self.conf.blocks_per_piece + 1
         self.max_requests = min(self.max_requests, self.conf.num_pieces)
 
+        # Rounds to be called in even if idle, see wake_at()
+        self.wake_rounds = set()
+
         self.post_init()
 
     def __repr__(self):
@@ -31,6 +53,13 @@ class Peer:
         """
         self.pieces = new_pieces
 
+    def wake_at(self, round):
+        """
+        Ask the event-driven engine to call requests() and uploads() in
+        round, even if this peer would be idle then.
+        """
+        self.wake_rounds.add(round)
+
     def requests(self, peers, history):
         return []
 
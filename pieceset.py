@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+"""
+Sets of piece ids stored as bitsets: bit i of an int is set if piece i is
+in the set.  Intersecting two of them (what can I get from this peer?) is a
+single AND over the whole int instead of a loop over the elements.
+
+PieceSet is read-only, and is what agents see as PeerInfo.available_pieces.
+It supports the read-only part of the set interface (in, len, iteration in
+increasing piece order, &, |, -, ^, intersection(), issubset(), ...), so
+agents written for python sets keep working.  The sim keeps one
+MutablePieceSet per peer and adds pieces to it as they complete.  That one
+is a bytearray, so adding a piece doesn't copy the whole bitset; it hands
+out a PieceSet snapshot, made once per change.
+
+Going from piece ids to bits and back uses numpy, if it's installed, for
+the big dense sets.  Small ones, like most per-neighbor intersections, use
+plain int operations.
+"""
+
+import itertools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def bit_indices(data):
+    """The indices of the set bits of a little-endian bytes-like, in order"""
+    return int_bit_indices(int.from_bytes(data, "little"))
+
+
+ZERO_ONE = bytes.maketrans(b"01", b"\0\1")
+
+# Up to this many set bits, peel them off the int one at a time
+FEW_BITS = 16
+# From this many bits long, a dense set goes through numpy
+NUMPY_BITS = 256
+
+
+def int_bit_indices(bits):
+    """The indices of the set bits of an int, in order"""
+    count = bits.bit_count()
+    if count <= FEW_BITS:
+        ans = []
+        while bits:
+            low = bits & -bits
+            ans.append(low.bit_length() - 1)
+            bits ^= low
+        return ans
+    length = bits.bit_length()
+    if np is not None and length >= NUMPY_BITS:
+        data = np.frombuffer(bits.to_bytes((length + 7) // 8, "little"),
+                             dtype=np.uint8)
+        return np.flatnonzero(np.unpackbits(data, bitorder="little")).tolist()
+    if 16 * count < length:
+        # Few bits set for the length: jump from one to the next
+        s = bin(bits)[:1:-1]
+        ans = []
+        i = s.find("1")
+        while i >= 0:
+            ans.append(i)
+            i = s.find("1", i + 1)
+        return ans
+    s = bin(bits)[:1:-1].encode().translate(ZERO_ONE)
+    return list(itertools.compress(range(len(s)), s))
+
+
+def to_bits(pieces):
+    """A PieceSet's bits, or the bits for an iterable of piece ids"""
+    if isinstance(pieces, (PieceSet, MutablePieceSet)):
+        return pieces.bits
+    if np is not None and isinstance(pieces, (list, tuple)) and len(pieces) > 64:
+        ids = np.asarray(pieces, dtype=np.intp)
+        flags = np.zeros(int(ids.max()) + 1, dtype=np.uint8)
+        flags[ids] = 1
+        return int.from_bytes(np.packbits(flags, bitorder="little").tobytes(),
+                              "little")
+    data = bytearray()
+    for i in pieces:
+        if i >= 8 * len(data):
+            data.extend(bytes(i // 8 + 1 - len(data)))
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(data, "little")
+
+
+def from_bits(bits):
+    """A PieceSet with these bits, without the to_bits() check in __init__"""
+    s = object.__new__(PieceSet)
+    s.bits = bits
+    return s
+
+
+class PieceSet:
+    __slots__ = ("bits",)
+
+    def __init__(self, pieces=(), bits=None):
+        self.bits = to_bits(pieces) if bits is None else bits
+
+    def __contains__(self, i):
+        return i >= 0 and (self.bits >> i) & 1 == 1
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __iter__(self):
+        if not self.bits:
+            return iter(())
+        return iter(int_bit_indices(self.bits))
+
+    def __and__(self, other):
+        if type(other) is PieceSet:
+            return from_bits(self.bits & other.bits)
+        return from_bits(self.bits & to_bits(other))
+
+    def __or__(self, other):
+        return from_bits(self.bits | to_bits(other))
+
+    def __sub__(self, other):
+        return from_bits(self.bits & ~to_bits(other))
+
+    def __xor__(self, other):
+        return from_bits(self.bits ^ to_bits(other))
+
+    __rand__ = __and__
+    __ror__ = __or__
+    __rxor__ = __xor__
+
+    def __rsub__(self, other):
+        return from_bits(to_bits(other) & ~self.bits)
+
+    def intersection(self, *others):
+        bits = self.bits
+        for other in others:
+            bits &= to_bits(other)
+        return from_bits(bits)
+
+    def union(self, *others):
+        bits = self.bits
+        for other in others:
+            bits |= to_bits(other)
+        return from_bits(bits)
+
+    def difference(self, *others):
+        bits = self.bits
+        for other in others:
+            bits &= ~to_bits(other)
+        return from_bits(bits)
+
+    def issubset(self, other):
+        return self.bits & ~to_bits(other) == 0
+
+    def issuperset(self, other):
+        return to_bits(other) & ~self.bits == 0
+
+    def isdisjoint(self, other):
+        if type(other) is PieceSet:
+            return not self.bits & other.bits
+        return self.bits & to_bits(other) == 0
+
+    def __eq__(self, other):
+        if isinstance(other, (PieceSet, set, frozenset)):
+            return self.bits == to_bits(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def frozen(self):
+        return self
+
+    def __repr__(self):
+        return "PieceSet(%s)" % list(self)
+
+
+class MutablePieceSet:
+    """
+    The sim's own copy of a peer's available pieces.
+    data: bytearray bitset, bit i % 8 of byte i // 8 set if piece i is in
+    count: how many pieces are in
+    snapshot: the PieceSet frozen() last handed out, or None if it changed since
+    """
+    __slots__ = ("data", "count", "snapshot")
+
+    def __init__(self, pieces=()):
+        self.data = bytearray()
+        self.count = 0
+        self.snapshot = None
+        for i in pieces:
+            self.add(i)
+
+    def add(self, i):
+        """Add piece i.  Adding a piece that is already in does nothing"""
+        (byte, bit) = (i >> 3, 1 << (i & 7))
+        if byte >= len(self.data):
+            self.data.extend(bytes(byte + 1 - len(self.data)))
+        if not self.data[byte] & bit:
+            self.data[byte] |= bit
+            self.count += 1
+            self.snapshot = None
+
+    def __contains__(self, i):
+        return (0 <= i and (i >> 3) < len(self.data) and
+                (self.data[i >> 3] >> (i & 7)) & 1 == 1)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.frozen())
+
+    @property
+    def bits(self):
+        return self.frozen().bits
+
+    def frozen(self):
+        """A read-only PieceSet snapshot, the same one until a piece is added"""
+        if self.snapshot is None:
+            self.snapshot = from_bits(int.from_bytes(self.data, "little"))
+        return self.snapshot
+
+    def __repr__(self):
+        return "MutablePieceSet(%s)" % list(self)
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+
+"""
+Piece state engines.  A piece state keeps track of how many blocks of each
+piece every peer in the simulation has.
+
+  - ListPieceState keeps one python list per peer (the original layout).
+  - ArrayPieceState keeps a single (num_peers, num_pieces) numpy matrix, so
+    block transfers and completion checks become batched array operations.
+  - SparsePieceState keeps each peer's completed pieces as a bitset and only
+    the pieces in progress explicitly, for files with a huge number of pieces.
+
+initial_pieces hands each engine every peer's starting blocks / piece, as a
+list or as UniformPieces.
+"""
+
+from collections.abc import Sequence
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from pieceset import bit_indices
+from util import ReadOnlyList
+
+
+class UniformPieces(Sequence):
+    """
+    The same number of blocks for every piece (all 0 for a new peer, all
+    blocks_per_piece for a seed), without storing a list.
+    """
+    __slots__ = ("value", "num_pieces")
+
+    def __init__(self, value, num_pieces):
+        self.value = value
+        self.num_pieces = num_pieces
+
+    def __len__(self):
+        return self.num_pieces
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.value] * len(range(*i.indices(self.num_pieces)))
+        if not -self.num_pieces <= i < self.num_pieces:
+            raise IndexError("piece %d out of range" % i)
+        return self.value
+
+
+class ListPieceState:
+    """
+    peer_pieces: dict : peer_id -> [blocks / piece]
+    """
+    def __init__(self, peer_ids, initial_pieces, blocks_per_piece):
+        self.peer_ids = peer_ids[:]
+        self.blocks_per_piece = blocks_per_piece
+        self.peer_pieces = dict((pid, initial_pieces[pid][:]) for pid in peer_ids)
+        self.views = dict((pid, ReadOnlyList(self.peer_pieces[pid]))
+                          for pid in peer_ids)
+
+    def pieces(self, peer_id):
+        """
+        Return a read-only view of the peer's blocks / piece list.  It follows
+        later updates, so it can be handed to agents without copying.
+        """
+        return self.views[peer_id]
+
+    def blocks(self, peer_id, piece_id):
+        return self.peer_pieces[peer_id][piece_id]
+
+    def available_pieces(self, peer_id):
+        """Return a list of piece ids that this peer has completed"""
+        bpp = self.blocks_per_piece
+        return [i for (i, b) in enumerate(self.peer_pieces[peer_id]) if b == bpp]
+
+    def add_blocks(self, peer_ids, piece_ids, blocks):
+        """
+        Give blocks[k] more blocks of piece piece_ids[k] to peer peer_ids[k],
+        in place.  Each (peer, piece) pair may appear at most once.
+
+        Returns a list of (peer_id, piece_id) for the pieces that are now complete.
+        """
+        bpp = self.blocks_per_piece
+        completed = []
+        for (peer_id, piece_id, b) in zip(peer_ids, piece_ids, blocks):
+            pieces = self.peer_pieces[peer_id]
+            pieces[piece_id] += b
+            if pieces[piece_id] == bpp:
+                completed.append((peer_id, piece_id))
+        return completed
+
+
+class ArrayPieceState:
+    """
+    matrix: numpy int array, one row per peer (in peer_ids order) and one
+            column per piece.
+    """
+    def __init__(self, peer_ids, initial_pieces, blocks_per_piece):
+        if np is None:
+            raise ImportError("The numpy piece engine needs numpy installed")
+        self.peer_ids = peer_ids[:]
+        self.blocks_per_piece = blocks_per_piece
+        self.row = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+        self.matrix = np.array([initial_pieces[pid][:] for pid in peer_ids],
+                               dtype=np.int32)
+        self.make_views()
+
+    def make_views(self):
+        self.views = dict()
+        for pid in self.peer_ids:
+            view = self.matrix[self.row[pid]]
+            view.flags.writeable = False
+            self.views[pid] = view
+
+    def __getstate__(self):
+        # Pickled views would be copies, not views of the matrix
+        state = self.__dict__.copy()
+        del state["views"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.make_views()
+
+    def pieces(self, peer_id):
+        """A read-only row view of the matrix"""
+        return self.views[peer_id]
+
+    def blocks(self, peer_id, piece_id):
+        return int(self.matrix[self.row[peer_id], piece_id])
+
+    def available_pieces(self, peer_id):
+        row = self.matrix[self.row[peer_id]]
+        return np.flatnonzero(row == self.blocks_per_piece).tolist()
+
+    def add_blocks(self, peer_ids, piece_ids, blocks):
+        if len(peer_ids) == 0:
+            return []
+        rows = np.fromiter((self.row[pid] for pid in peer_ids),
+                           dtype=np.intp, count=len(peer_ids))
+        cols = np.asarray(piece_ids, dtype=np.intp)
+        np.add.at(self.matrix, (rows, cols), np.asarray(blocks, dtype=np.int32))
+        now_done = self.matrix[rows, cols] == self.blocks_per_piece
+        return [(peer_ids[k], piece_ids[k]) for k in np.flatnonzero(now_done)]
+
+
+class SparsePieces(Sequence):
+    """
+    Read-only view of one peer's blocks / piece in a SparsePieceState.
+    Indexing works as for a list.
+    """
+    __slots__ = ("state", "peer_id")
+
+    def __init__(self, state, peer_id):
+        self.state = state
+        self.peer_id = peer_id
+
+    def __len__(self):
+        return self.state.num_pieces
+
+    def __getitem__(self, i):
+        n = self.state.num_pieces
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(n))]
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("piece %d out of range" % i)
+        return self.state.blocks(self.peer_id, i)
+
+    def __repr__(self):
+        return "SparsePieces(%s: %d done, in progress %s)" % (
+            self.peer_id,
+            int.from_bytes(self.state.done[self.peer_id], "little").bit_count(),
+            self.state.partial[self.peer_id])
+
+
+class SparsePieceState:
+    """
+    done: dict : peer_id -> bytearray, a bitset with bit i (bit i % 8 of
+          byte i // 8) set if piece i is done
+    partial: dict : peer_id -> dict : piece_id -> blocks, for the pieces
+             started but not finished
+    A new peer costs num_pieces / 8 bytes and an empty dict, instead of a
+    list of num_pieces ints.
+    """
+    def __init__(self, peer_ids, initial_pieces, blocks_per_piece):
+        self.peer_ids = peer_ids[:]
+        self.blocks_per_piece = blocks_per_piece
+        self.num_pieces = len(initial_pieces[peer_ids[0]]) if peer_ids else 0
+        self.done = dict()
+        self.partial = dict()
+        n = self.num_pieces
+        all_done = ((1 << n) - 1).to_bytes((n + 7) // 8, "little")
+        for pid in peer_ids:
+            pieces = initial_pieces[pid]
+            if isinstance(pieces, UniformPieces) and pieces.value in (0, blocks_per_piece):
+                if pieces.value == blocks_per_piece:
+                    self.done[pid] = bytearray(all_done)
+                else:
+                    self.done[pid] = bytearray(len(all_done))
+                self.partial[pid] = dict()
+                continue
+            done = bytearray(len(all_done))
+            partial = dict()
+            for (i, b) in enumerate(pieces):
+                if b == blocks_per_piece:
+                    done[i >> 3] |= 1 << (i & 7)
+                elif b > 0:
+                    partial[i] = b
+            self.done[pid] = done
+            self.partial[pid] = partial
+        self.views = dict((pid, SparsePieces(self, pid)) for pid in peer_ids)
+
+    def pieces(self, peer_id):
+        """A read-only SparsePieces view"""
+        return self.views[peer_id]
+
+    def blocks(self, peer_id, piece_id):
+        if (self.done[peer_id][piece_id >> 3] >> (piece_id & 7)) & 1:
+            return self.blocks_per_piece
+        return self.partial[peer_id].get(piece_id, 0)
+
+    def available_pieces(self, peer_id):
+        return bit_indices(self.done[peer_id])
+
+    def add_blocks(self, peer_ids, piece_ids, blocks):
+        bpp = self.blocks_per_piece
+        completed = []
+        for (peer_id, piece_id, b) in zip(peer_ids, piece_ids, blocks):
+            done = self.done[peer_id]
+            if (done[piece_id >> 3] >> (piece_id & 7)) & 1:
+                continue   # already complete: it doesn't complete again
+            partial = self.partial[peer_id]
+            now = partial.get(piece_id, 0) + b
+            if now == bpp:
+                partial.pop(piece_id, None)
+                done[piece_id >> 3] |= 1 << (piece_id & 7)
+                completed.append((peer_id, piece_id))
+            else:
+                partial[piece_id] = now
+        return completed
+
+
+ENGINES = {"list": ListPieceState,
+           "numpy": ArrayPieceState,
+           "sparse": SparsePieceState}
+
+
+def make_piece_state(engine, peer_ids, initial_pieces, blocks_per_piece):
+    """
+    engine: one of the keys of ENGINES
+    initial_pieces: dict : peer_id -> [blocks / piece] or UniformPieces
+    """
+    if engine not in ENGINES:
+        raise ValueError("Unknown piece engine: %s" % engine)
+    return ENGINES[engine](peer_ids, initial_pieces, blocks_per_piece)
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+"""
+Opt-in profiling for sim.py --profile.
+
+  - cprofile: the deterministic profiler, stats written to a file for pstats
+    or snakeviz.  Slows the run down noticeably.
+  - sample: a sampling profiler.  A background thread looks at the main
+    thread's stack every few milliseconds, so the overhead is small.  Prints
+    the functions the most samples were in.
+"""
+
+import cProfile
+import collections
+import logging
+import os
+import sys
+import threading
+
+
+class SamplingProfiler:
+    """
+    self_counts: (file, line, function) -> samples with that function on top
+    total_counts: (file, line, function) -> samples with it anywhere on the stack
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.self_counts = collections.Counter()
+        self.total_counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            self.samples += 1
+            seen = set()
+            top = True
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_filename, code.co_firstlineno, code.co_name)
+                if top:
+                    self.self_counts[key] += 1
+                    top = False
+                if key not in seen:
+                    self.total_counts[key] += 1
+                    seen.add(key)
+                frame = frame.f_back
+
+    def pretty(self, limit=25):
+        def table(counts):
+            return "\n".join("%6.1f%%  %s:%d(%s)" % (
+                100.0 * n / max(self.samples, 1), os.path.basename(f), line, name)
+                             for ((f, line, name), n) in counts.most_common(limit))
+        return ("%d samples, every %.0f ms\n\nSelf time:\n%s\n\nTotal time:\n%s" % (
+            self.samples, 1000 * self.interval,
+            table(self.self_counts), table(self.total_counts)))
+
+
+def profile_call(mode, f, out):
+    """Call f under the profiler named by mode ('cprofile' or 'sample')"""
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            f()
+        finally:
+            profiler.disable()
+            profiler.dump_stats(out)
+            logging.warning("Wrote profile to %s", out)
+    elif mode == "sample":
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            f()
+        finally:
+            profiler.stop()
+            logging.warning("======== PROFILE ========\n%s", profiler.pretty())
+    else:
+        raise ValueError("Unknown profiler: %s" % mode)
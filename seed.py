@@ -1,24 +1,28 @@
 #!/usr/bin/python
 
-import random
 from messages import Upload, Request
 from util import even_split
 from peer import Peer
 
 class Seed(Peer):
+    history_window = 0
+    idle_when_done = True
+    idle_without_requests = True
+
     def requests(self, peers, history):
         # Seeds don't need anything.
         return []
 
     def uploads(self, requests, peers, history):
         max_upload = 4  # max num of peers to upload to at a time
-        requester_ids = list(set([r.requester_id for r in requests]))
+        # sorted, so the order doesn't depend on string hashing
+        requester_ids = sorted(set([r.requester_id for r in requests]))
 
         n = min(max_upload, len(requester_ids))
         if n == 0:
             return []
         bws = even_split(self.up_bw, n)
         uploads = [Upload(self.id, p_id, bw)
-                   for (p_id, bw) in zip(random.sample(requester_ids, n), bws)]
+                   for (p_id, bw) in zip(self.rng.sample(requester_ids, n), bws)]
         
         return uploads
@@ -8,6 +8,7 @@ Simulates one file being shared amongst a set of peers.  The file is divided int
 The simulation proceeds in rounds.  In each round, peers can request pieces from other peers, and then decide how much to upload to others.  Once every peer has every piece, the simulation ends.
 """
 
+import os
 import re
 import random
 import sys
@@ -15,18 +16,78 @@ import logging
 import copy
 import itertools
 import pprint
+import multiprocessing
 from optparse import OptionParser
 
 from messages import Upload, Request, Download, PeerInfo
 from util import *
 from stats import Stats
-from history import History
+from history import HISTORIES, agent_windows, make_history
+import checkpoint
+import piecestate
+import profiling
+from piecestate import ENGINES, UniformPieces, make_piece_state
+from pieceset import MutablePieceSet
+from topology import TOPOLOGIES, NeighborhoodCounts, make_topology
+from tracker import POLICIES, Tracker
+from timing import AgentAccounts, BUDGET_CLOCKS, PhaseTimer, clock, timed_call
+from agentpool import AgentPool, RemotePeer, ThreadAgentPool, resolve_isolation
+
+
+def peer_ids_for(agent_class_names):
+    """Peer ids are the class name plus a per-class counter: Seed0, Seed1, ..."""
+    counts = dict()
+    def index(name):
+        if name in counts:
+            a = counts[name]
+            counts[name] += 1
+        else:
+            a = 0
+            counts[name] = 1
+        return a
+
+    return ["%s%d" % (n, index(n)) for n in agent_class_names]
+
+
+def run_iteration(job):
+    """
+    job: (sim, seed)
+
+    Run one simulation from seed, and return (uploaded blocks, completion
+    rounds, timers).  The first two are dicts keyed by peer id.  timers is
+    (phase timer, agent accounts) for this iteration; the phase timer is
+    None unless the config asks for timings, and the accounts are None
+    unless it asks for timings or a time budget.  The global random module
+    is seeded too, for agents that still use it.
+    Module level so that it can be sent to worker processes.
+    """
+    (sim, seed) = job
+    conf = sim.config
+    random.seed(seed)
+    if conf.timings:
+        sim.timer = PhaseTimer()
+    if conf.timings or conf.time_budget is not None:
+        sim.accounts = AgentAccounts(conf.time_budget, conf.budget_clock)
+    history = sim.run_sim_once(seed)
+    timers = (sim.timer, sim.accounts)
+    return (Stats.uploaded_blocks(sim.peer_ids, history),
+            Stats.completion_rounds(sim.peer_ids, history),
+            timers)
     
 
 class Sim:
-    def __init__(self, config):
+    def __init__(self, config, timer=None, accounts=None):
+        """
+        timer: optional timing.PhaseTimer.  If given, the time spent in each
+        phase of the round loop is added to it.
+        accounts: optional timing.AgentAccounts.  If given, every agent
+        requests() and uploads() call is timed and charged to its peer, and
+        the accounts' time budget enforced.
+        """
         self.config = config
         self.up_bws_state = dict()
+        self.timer = timer
+        self.accounts = accounts
 
     
     def up_bw(self, peer_id, reinit=False):
@@ -40,13 +101,27 @@ class Sim:
         
         """Sets the upload bandwidth of seeds to max, other agents at random"""
         if re.match("Seed",peer_id): the_up_bw = c.max_up_bw
-        else: the_up_bw = random.randint(c.min_up_bw, c.max_up_bw)
+        else: the_up_bw = self.rng.randint(c.min_up_bw, c.max_up_bw)
         
         return s.setdefault(peer_id, the_up_bw)
 
-    def run_sim_once(self):
-        """Return a history"""
+    def base_seed(self):
+        """The --seed option, or a fresh random seed if there isn't one"""
+        if self.config.seed is not None:
+            return self.config.seed
+        return random.randrange(2**32)
+
+    def run_sim_once(self, seed=None):
+        """
+        Return a history.
+        Everything random in the simulation comes from seed: the sim's rng
+        (for the upload bandwidths) and the rng handed to each peer.  So the
+        same seed gives the same history, whatever ran before it.
+        """
         conf = self.config
+        if seed is None:
+            seed = random.randrange(2**32)
+        self.rng = random.Random(derive_seed(seed, "sim"))
         # Keep track of the current round.  Needs to be in scope for helpers.
         round = 0  
 
@@ -54,13 +129,30 @@ class Sim:
             """Check if any element of lst matches the predicate.  If it does,
             raise an exception of type Exc, including the msg and the offending
             element."""
-            m = list(map(pred, lst))
-            if True in m:
-                i = m.index(True)
-                raise Exc(msg + " Bad element: %s" % lst[i])
+            for o in lst:
+                if pred(o):
+                    raise Exc(msg + " Bad element: %s" % o)
 
         def check_uploads(peer, uploads):
-            """Raise an IllegalUpload exception if there is a problem."""
+            """
+            Raise an IllegalUpload exception if there is a problem.
+            One pass over the uploads; only if that finds something wrong
+            are the checks run one by one, to report the problem.
+            """
+            if peer.id in trusted_ids:
+                return
+            peer_id = peer.id
+            total = 0
+            for u in uploads:
+                if not (isinstance(u, Upload) and u.to_id != peer_id and
+                        u.from_id == peer_id and u.bw >= 0):
+                    explain_bad_uploads(peer, uploads)
+                total += u.bw
+            if total > self.up_bw(peer_id):
+                explain_bad_uploads(peer, uploads)
+
+        def explain_bad_uploads(peer, uploads):
+            """Raise an IllegalUpload exception for the first problem found."""
             def check(pred, msg):
                 check_pred(pred, msg, IllegalUpload, uploads)
 
@@ -82,8 +174,33 @@ class Sim:
 
             # If we got here, looks ok.
 
-        def check_requests(peer, requests, peer_pieces, available):
-            """Raise an IllegalRequest exception if there is a problem."""
+        def check_requests(peer, requests, piece_state, available):
+            """
+            Raise an IllegalRequest exception if there is a problem.
+            One pass over the requests, as for the uploads.
+            """
+            if peer.id in trusted_ids:
+                return
+            peer_id = peer.id
+            num_pieces = conf.num_pieces
+            bpp = conf.blocks_per_piece
+            pieces = piece_state.pieces(peer_id)
+            if topology.neighbors is None:
+                allowed = peer_id_set
+            else:
+                allowed = topology.neighbors[peer_id]
+            for r in requests:
+                if not (isinstance(r, Request) and
+                        0 <= r.piece_id < num_pieces and
+                        r.peer_id in allowed and
+                        r.requester_id == peer_id and
+                        0 <= r.start < bpp and
+                        r.start <= pieces[r.piece_id] and
+                        r.piece_id in available[r.peer_id]):
+                    explain_bad_requests(peer, requests, piece_state, available)
+
+        def explain_bad_requests(peer, requests, piece_state, available):
+            """Raise an IllegalRequest exception for the first problem found."""
 
             def check(pred, msg):
                 check_pred(pred, msg, IllegalRequest, requests)
@@ -95,122 +212,235 @@ class Sim:
                                       r.piece_id >= self.config.num_pieces)
             check(bad_piece_id, "Request asks for non-existent piece!")
             
-            bad_peer_id = lambda r: r.peer_id not in self.peer_ids
+            bad_peer_id = lambda r: r.peer_id not in peer_id_set
             check(bad_peer_id, "Request mentions non-existent peer!")
 
+            if topology.neighbors is not None:
+                not_neighbor = lambda r: r.peer_id not in topology.neighbors[peer.id]
+                check(not_neighbor, "Request to a peer that isn't a neighbor!")
+
             bad_requester_id = lambda r: r.requester_id != peer.id
             check(bad_requester_id, "Request has wrong peer id!")
 
             bad_start_block = lambda r: (
                 r.start < 0 or
                 r.start >= self.config.blocks_per_piece or
-                r.start > peer_pieces[peer.id][r.piece_id])
+                r.start > piece_state.blocks(peer.id, r.piece_id))
             # Must request the _next_ necessary block
             check(bad_start_block, "Request has bad start block!")
 
             def piece_peer_does_not_have(r):
-                other_peer = self.peers_by_id[r.peer_id]
-                return r.piece_id not in available[other_peer.id]
+                return r.piece_id not in available[r.peer_id]
             check(piece_peer_does_not_have, "Asking for piece peer does not have!")
             
             # If we got here, looks ok
 
-        def available_pieces(peer_id, peer_pieces):
+        def all_done(unfinished, newly_done):
             """
-            Return a list of piece ids that this peer has available.
+            unfinished: set of ids of the peers still missing pieces
+            newly_done: ids of the peers that finished since the last check.
+            Records those in the history, and empties the list.
             """
-            return [i for i in range(conf.num_pieces) if peer_pieces[peer_id][i] == conf.blocks_per_piece]
-
-        def peer_done(peer_pieces, peer_id):
-            # TODO: remove linear pass
-            for blocks_so_far in peer_pieces[peer_id]:
-                if blocks_so_far < conf.blocks_per_piece:
-                    return False
-            return True
-            
-        def all_done(peer_pieces):
-            result = True
-            # Check all peers to update done status
-            for peer_id in peer_pieces:
-                if peer_done(peer_pieces, peer_id):
-                    history.peer_is_done(round, peer_id)
-                else:
-                    result = False
-            return result
+            for peer_id in newly_done:
+                history.peer_is_done(round, peer_id)
+            del newly_done[:]
+            return len(unfinished) == 0
 
         def create_peers():
             """Each agent class must be already loaded, and have a
-            constructor that takes the config, id,  pieces, and
-            up and down bandwidth, in that order."""
+            constructor that takes the config, id,  pieces,
+            up bandwidth and random.Random, in that order."""
 
             def load(class_name, params):
                 agent_class = conf.agent_classes[class_name]
                 return agent_class(*params)
 
-            counts = dict()
-            def index(name):
-                if name in counts:
-                    a = counts[name]
-                    counts[name] += 1
-                else:
-                    a = 0
-                    counts[name] = 1
-                return a
-
-            n = len(conf.agent_class_names)
-            ids = ["%s%d" % (n,index(n)) for n in conf.agent_class_names]
+            ids = peer_ids_for(conf.agent_class_names)
 
             is_seed = lambda id: id.startswith("Seed")
 
             def get_pieces(id):
                 if id.startswith("Seed"):
-                    return [conf.blocks_per_piece]*conf.num_pieces
+                    return UniformPieces(conf.blocks_per_piece, conf.num_pieces)
                 else:
-                    return [0]*conf.num_pieces
+                    return UniformPieces(0, conf.num_pieces)
                 
-            peer_pieces = dict()  # id -> list (blocks / piece)
+            peer_pieces = dict()  # id -> blocks / piece (UniformPieces)
             peer_pieces = dict((id, get_pieces(id)) for id in ids)
-            pieces = [get_pieces(id) for id in ids]
+            piece_state = make_piece_state(conf.piece_engine, ids, peer_pieces,
+                                           conf.blocks_per_piece)
+            pieces = [piece_state.pieces(id) for id in ids]
             r = itertools.repeat
             
             # Re-initialize upload bandwidths at the beginning of each
             # new simulation
             up_bws = [self.up_bw(id, reinit=True) for id in ids] 
-            params = list(zip(r(conf), ids, pieces, up_bws))
+            rngs = [random.Random(derive_seed(seed, id)) for id in ids]
+            params = list(zip(r(conf), ids, pieces, up_bws, rngs))
+
+            if conf.isolation == "process":
+                # The agents only exist in the pool's worker processes
+                agent_pool = AgentPool(conf, seed, ids, peer_pieces,
+                                       dict(zip(ids, up_bws)), conf.agent_workers)
+                peers = [RemotePeer(id, bw) for (id, bw) in zip(ids, up_bws)]
+                return peers, piece_state, agent_pool
 
             peers = list(map(load, conf.agent_class_names, params))
             #logging.debug("Peers: \n" + "\n".join(str(p) for p in peers))
-            return peers, peer_pieces
+            return peers, piece_state, None
 
-        def get_peer_requests(p, peer_info, peer_history, peer_pieces, available):
-            def remove_me(info):
-                # TODO: Do we need this linear pass?
-                return [peer for peer in peer_info if peer.id != p.id]
+        def idle_requests(p):
+            """
+            Can the event-driven engine skip p's requests() this round?
+            Only if its class promises it does nothing once done.
+            """
+            return (p.idle_when_done and p.id not in unfinished and
+                    round not in p.wake_rounds)
+
+        def idle_uploads(p, requests):
+            """As idle_requests, for uploads() with requests made to p"""
+            return (p.idle_without_requests and len(requests) == 0 and
+                    round not in p.wake_rounds)
+
+        def history_path():
+            """Where a streamed history goes: one file per iteration"""
+            if conf.history_out is None:
+                return None
+            if conf.sweep_config is not None:
+                return "%s.%s.%s" % (conf.history_out, conf.sweep_config, seed)
+            if conf.iters == 1:
+                return conf.history_out
+            return "%s.%s" % (conf.history_out, seed)
+
+        def call_agent(p, name, f, *args):
+            """
+            Call p's requests or uploads method f (name says which) with args.
+            With accounts, the call is timed and charged to p, and a peer
+            that goes over its time budget for the round gets [] instead.
+            Once over, its calls are skipped for the rest of the round.
+            """
+            if accounts is None:
+                return f(*args)
+            if skip_agent(p, name):
+                return []
+            (result, wall, cpu) = timed_call(f, *args)
+            return charge_agent(p, name, result, wall, cpu)
+
+        def skip_agent(p, name):
+            """Is p already over its time budget for this round?"""
+            if accounts is not None and accounts.over_budget(round, p.id):
+                logging.warning("Round %d: %s is over its time budget, "
+                                "skipping its %s", round, p.id, name)
+                return True
+            return False
+
+        def charge_agent(p, name, result, wall, cpu):
+            """
+            Charge p for a call that took wall / cpu seconds and returned
+            result.  Returns the result, or [] if p is now over its budget.
+            """
+            if accounts is None:
+                return result
+            if not accounts.charge(round, p.id, name, wall, cpu):
+                logging.warning("Round %d: %s went over its time budget in "
+                                "%s (%.1f ms this round), ignoring its %s",
+                                round, p.id, name,
+                                1000 * accounts.spent[p.id], name)
+                return []
+            return result
 
-            pieces = copy.copy(peer_pieces[p.id])
-            # Made copy of pieces and the peer info this peer needs to make it's
-            # decision, so that it can't change the simulation's copies.
+        def remote_replies(p, name, reply):
+            """
+            One agent's reply from the agent pool (worker processes or
+            threads): (messages, wall, cpu, error).  A crashed agent is
+            logged, and gets [].
+            """
+            (result, wall, cpu, error) = reply
+            if result is None:
+                skip_agent(p, name)
+                return []
+            if error is not None:
+                logging.warning("Round %d: %s crashed in %s, ignoring its %s:\n%s",
+                                round, p.id, name, name, error)
+            return charge_agent(p, name, result, wall, cpu)
+
+        def get_remote_requests(piece_state, available, completed, downloads,
+                                uploads, changed):
+            """
+            Get every peer's requests from the agent pool in one batch.
+            completed, downloads, uploads: last round's results, for the
+            pool's mirror of the simulation.
+            changed: the peers whose neighbors changed since the last round
+            """
+            start = clock()
+            new_neighbors = dict((pid, topology.neighbor_ids(pid)) for pid in changed)
+            replies = agent_pool.requests(round, completed, downloads, uploads,
+                                          new_neighbors)
+            agent_done = clock()
+            requests = dict()
+            for p in peers:
+                rs = remote_replies(p, "requests", replies[p.id])
+                check_requests(p, rs, piece_state, available)
+                requests[p.id] = rs
+            if timer is not None:
+                timer.add("agent requests", agent_done - start)
+                timer.add("check_requests", clock() - agent_done)
+            return requests
+
+        def get_remote_uploads(requests_to):
+            start = clock()
+            skip = set()
+            if accounts is not None:
+                skip = set(p.id for p in peers if accounts.over_budget(round, p.id))
+            replies = agent_pool.uploads(requests_to, skip)
+            agent_done = clock()
+            uploads = dict()
+            for p in peers:
+                us = remote_replies(p, "uploads", replies[p.id])
+                check_uploads(p, us)
+                uploads[p.id] = us
+            if timer is not None:
+                timer.add("agent uploads", agent_done - start)
+                timer.add("check_uploads", clock() - agent_done)
+            return uploads
+
+        def get_peer_requests(p, peer_history, piece_state, available):
+            pieces = piece_state.pieces(p.id)
+            # The pieces are a read-only view of the simulation's state, so
+            # this peer can't change it, and there's no copy to make every round.
             p.update_pieces(pieces)
-            rs = p.requests(remove_me(peer_info), peer_history)
-            check_requests(p, rs, peer_pieces, available)
+            start = clock()
+            rs = call_agent(p, "requests", p.requests, others(p.id), peer_history)
+            agent_done = clock()
+            check_requests(p, rs, piece_state, available)
+            if timer is not None:
+                timer.add("agent requests", agent_done - start)
+                timer.add("check_requests", clock() - agent_done)
             return rs
 
-        def get_peer_uploads(all_requests, p, peer_info, peer_history):
-            def remove_me(info):
-                # TODO: remove this pass?  Use a set?
-                return [peer for peer in peer_info if peer.id != p.id]
-
-            def requests_to(id):
-                f = lambda r: r.peer_id == id
-                ans = []
-                for rs in list(all_requests.values()):
-                    ans.extend(list(filter(f, rs)))
-                return ans
-
-            requests = requests_to(p.id)
+        def index_requests(requests):
+            """
+            requests: dict : requester_id -> [Requests]
 
-            us = p.uploads(requests, remove_me(peer_info), peer_history)
+            Return dict : peer_id -> [Requests asking that peer for data],
+            keeping the order the requests were made in.
+            """
+            requests_to = dict((pid, []) for pid in self.peer_ids)
+            for rs in requests.values():
+                for r in rs:
+                    requests_to[r.peer_id].append(r)
+            return requests_to
+
+        def get_peer_uploads(requests, p, peer_history):
+            """requests: the requests made to p this round"""
+            start = clock()
+            us = call_agent(p, "uploads", p.uploads, requests, others(p.id),
+                            peer_history)
+            agent_done = clock()
             check_uploads(p, us)
+            if timer is not None:
+                timer.add("agent uploads", agent_done - start)
+                timer.add("check_uploads", clock() - agent_done)
             return us
 
         def upload_rate(uploads, uploader_id, requester_id):
@@ -223,16 +453,23 @@ class Sim:
                     return u.bw
             return 0
 
-        def update_peer_pieces(peer_pieces, requests, uploads, available):
+        def update_peer_pieces(piece_state, requests, uploads, available,
+                               piece_counts, unfinished, newly_done):
             """
             Process the uploads: figure out how many blocks of all the requested
             pieces the requesters ended up with.
             Make sure requesting the same thing from lots of peers doesn't
             stack.
-            update the sets of available pieces as needed.
+            The block transfers of the whole round are applied to piece_state
+            as one batch, and the sets of available pieces and the swarm's
+            piece counts updated as needed.  Peers that now have every piece
+            move from unfinished to newly_done.
+
+            Returns (downloads, [(peer_id, piece_id)] for the pieces completed).
             """
             downloads = dict()  # peer_id -> [downloads]
-            new_pp = copy.deepcopy(peer_pieces)
+            # The round's transfers, in parallel lists
+            to_ids, piece_ids, new_blocks = [], [], []
             for requester_id in requests:
                 downloads[requester_id] = list()
             for requester_id in requests:
@@ -256,7 +493,8 @@ class Sim:
                         continue
                     # This bandwidth gets applied in order to each piece requested
                     for r in rs_for_peer:
-                        needed_blocks = conf.blocks_per_piece - r.start
+                        # (int: start may come from a numpy piece view)
+                        needed_blocks = conf.blocks_per_piece - int(r.start)
                         alloced_bw = min(bw, needed_blocks)
                         update_count(r.piece_id, alloced_bw, peer_id)
                         bw -= alloced_bw
@@ -264,91 +502,306 @@ class Sim:
                             break
                 for piece_id in new_blocks_per_piece:
                     (blocks, peer_id) = new_blocks_per_piece[piece_id]
-                    new_pp[requester_id][piece_id] += blocks
-                    if new_pp[requester_id][piece_id] == conf.blocks_per_piece:
-                        available[requester_id].add(piece_id)
+                    to_ids.append(requester_id)
+                    piece_ids.append(piece_id)
+                    new_blocks.append(blocks)
                     d = Download(peer_id, requester_id, piece_id, blocks)
                     downloads[requester_id].append(d)
-                
-            return (new_pp, downloads)
+
+            completed = piece_state.add_blocks(to_ids, piece_ids, new_blocks)
+            for (requester_id, piece_id) in completed:
+                available[requester_id].add(piece_id)
+                piece_counts[piece_id] += 1
+                if local_counts is not None:
+                    local_counts.completed(requester_id, piece_id)
+                if len(available[requester_id]) == conf.num_pieces:
+                    unfinished.discard(requester_id)
+                    newly_done.append(requester_id)
+
+            return (downloads, completed)
 
         def completed_pieces(peer_id, available):
             return len(available[peer_id])
         
-        def log_peer_info(peer_pieces, available):
-            for p_id in self.peer_ids:
-                pieces = peer_pieces[p_id]
-                logging.debug("pieces for %s: %s" % (str(p_id), str(pieces)))
-            log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
-                            for p_id in self.peer_ids)
-            logging.info("Pieces completed: " + log)
-
-
-        logging.debug("Starting simulation with config: %s" % str(conf))
-
-        peers, peer_pieces = create_peers()
-        self.peer_ids = [p.id for p in peers]
+        def log_peer_info(piece_state, available):
+            if debug_on:
+                for p_id in self.peer_ids:
+                    pieces = piece_state.pieces(p_id)
+                    logging.debug("pieces for %s: %s", p_id, pieces)
+            if info_on:
+                log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
+                                for p_id in self.peer_ids)
+                logging.info("Pieces completed: %s", log)
+
+
+        # Only build the per-round log text if someone is going to see it.
+        # (The level can't change during a simulation.)
+        debug_on = logging.getLogger().isEnabledFor(logging.DEBUG)
+        info_on = logging.getLogger().isEnabledFor(logging.INFO)
+
+        logging.debug("Starting simulation with config: %s", conf)
+
+        timer = self.timer
+        accounts = self.accounts
+        setup_start = clock()
+
+        if conf.resume:
+            (round, peers, piece_state, history, available, piece_counts,
+             unfinished, topology) = checkpoint.restore(conf.resume, self)
+            (agent_pool, newly_done) = (None, [])
+            self.peer_ids = [p.id for p in peers]
+            logging.info("Resuming %s at round %d", conf.resume, round)
+        else:
+            peers, piece_state, agent_pool = create_peers()
+            self.peer_ids = [p.id for p in peers]
+
+            upload_rates = dict((id, self.up_bw(id)) for id in self.peer_ids)
+            windows = agent_windows(self.peer_ids,
+                                    [conf.agent_classes[name]
+                                     for name in conf.agent_class_names],
+                                    conf.history_window)
+            history = make_history(conf.history, self.peer_ids, upload_rates,
+                                   windows, history_path())
+
+            # dict : pid -> MutablePieceSet(finished / available pieces)
+            available = dict((pid, MutablePieceSet(piece_state.available_pieces(pid)))
+                             for pid in self.peer_ids)
+
+            # How many peers have each piece.  Kept up to date as pieces
+            # complete, so agents doing rarest first don't have to recount
+            # every round.
+            piece_counts = [0] * conf.num_pieces
+            for pid in self.peer_ids:
+                for piece_id in available[pid]:
+                    piece_counts[piece_id] += 1
+
+            # The size of a peer's available set is its count of completed
+            # pieces, so a peer is done as soon as that reaches num_pieces
+            # and there's no need to go over every peer's pieces each round.
+            # Seeds start out done; they are recorded at the end of round 0.
+            newly_done = [pid for pid in self.peer_ids
+                          if len(available[pid]) == conf.num_pieces]
+            unfinished = set(self.peer_ids) - set(newly_done)
+
+            tracker = None
+            if conf.topology == "tracker":
+                tracker = Tracker(self.peer_ids, unfinished,
+                                  random.Random(derive_seed(seed, "tracker")),
+                                  conf.announce_interval, conf.peer_list_size,
+                                  conf.tracker_policy)
+            topology = make_topology(conf.topology, self.peer_ids, conf.degree,
+                                     random.Random(derive_seed(seed, "topology")),
+                                     conf.clusters, tracker, unfinished)
+
+        history.piece_counts = ReadOnlyList(piece_counts)
         self.peers_by_id = dict((p.id, p) for p in peers)
-        
-        upload_rates = dict((id, self.up_bw(id)) for id in self.peer_ids)
-        history = History(self.peer_ids, upload_rates)
-
-        # dict : pid -> set(finished / available pieces)
-        available = dict((pid, set(available_pieces(pid, peer_pieces)))
-                         for pid in self.peer_ids)
+        peer_id_set = set(self.peer_ids)
+        # Peers whose requests and uploads aren't checked
+        trusted_ids = set(pid for (pid, name) in zip(self.peer_ids,
+                                                     conf.agent_class_names)
+                          if name in conf.trusted_agents)
+
+        # The available sets are only changed in place, so the PeerInfo
+        # objects can be made once for the whole simulation.  Agents get
+        # read-only PieceSet snapshots of them.
+        peer_info = [PeerInfo(p.id, available[p.id])
+                     for p in peers]
+        peer_info_by_id = dict((info.id, info) for info in peer_info)
+
+        def neighbor_info(peer_id):
+            return [peer_info_by_id[pid] for pid in topology.neighbor_ids(peer_id)]
+
+        # dict : peer_id -> [PeerInfo of its neighbors], rebuilt only for the
+        # peers whose neighbors change.  None when everyone sees everyone:
+        # then the lists are made as needed, rather than kept for every peer.
+        neighbors = None
+        # And the piece counts over each peer's neighborhood, which are the
+        # ones its history shows then: it can't know about the others.
+        local_counts = None
+        if topology.neighbors is not None:
+            neighbors = dict((pid, neighbor_info(pid)) for pid in self.peer_ids)
+            local_counts = NeighborhoodCounts(conf.num_pieces, available)
+            for pid in self.peer_ids:
+                local_counts.rebuild(pid, topology.neighbors[pid])
+            history.neighborhood_counts = local_counts.views
+
+        def others(peer_id):
+            """
+            The PeerInfo peer_id gets to see, as a new list: agents may sort
+            or change it, but not the sim's copy.
+            """
+            if neighbors is None:
+                return [peer for peer in peer_info if peer.id != peer_id]
+            return list(neighbors[peer_id])
+
+        # Peers whose neighbors changed, for the agent pool's mirror.  At the
+        # start it hasn't seen any.
+        changed = set()
+        if neighbors is not None:
+            changed = set(self.peer_ids)
+
+        if conf.isolation == "thread":
+            agent_pool = ThreadAgentPool(peers, others, history, piece_state,
+                                         conf.agent_workers)
+
+        # Last round's results, for the agent pool
+        (completed, downloads, uploads) = ([], dict(), dict())
+
+        # With the event-driven engine, only call the agents whose inputs
+        # changed (see Peer.idle_when_done): the history is the same.
+        event_driven = conf.engine == "event"
+        skipped_calls = 0
+
+        checkpointer = None
+        if conf.checkpoint:
+            # Carry on appending if resuming from the same file
+            same_file = (conf.resume and
+                         os.path.abspath(conf.resume) == os.path.abspath(conf.checkpoint))
+            checkpointer = checkpoint.Checkpointer(conf.checkpoint,
+                                                   round if same_file else 0)
+
+        if timer is not None:
+            timer.add("setup", clock() - setup_start)
+
+        if round > conf.max_round:
+            # Resumed from the checkpoint taken when the run ran out of time
+            logging.info("Out of time.  Stopping.")
 
         # Begin the event loop
-        while True:
-            logging.info("======= Round %d ========" % round)
-
-            peer_info = [PeerInfo(p.id, available[p.id])
-                         for p in peers]
-            requests = dict()  # peer_id -> list of Requests
-            uploads = dict()   # peer_id -> list of Uploads
+        while round <= conf.max_round:
+            logging.info("======= Round %d ========", round)
+
+            t0 = clock()
+            if neighbors is not None:
+                now_changed = topology.update(round, unfinished)
+                for pid in now_changed:
+                    neighbors[pid] = neighbor_info(pid)
+                    local_counts.rebuild(pid, topology.neighbors[pid])
+                changed.update(now_changed)
             h = dict()
-            for p in peers:
-                h[p.id] = history.peer_history(p.id)
-                requests[p.id] = get_peer_requests(p, peer_info, h[p.id], peer_pieces,
-                                                   available)
-
-            for p in peers:
-                uploads[p.id] = get_peer_uploads(requests, p, peer_info, h[p.id])
-                
-
-            (peer_pieces, downloads) = update_peer_pieces(
-                peer_pieces, requests, uploads, available)
+            if agent_pool is None:
+                requests = dict()  # peer_id -> list of Requests
+                for p in peers:
+                    if not event_driven or not idle_requests(p):
+                        h[p.id] = history.peer_history(p.id)
+                t1 = clock()
+                for p in peers:
+                    if p.id in h:
+                        requests[p.id] = get_peer_requests(p, h[p.id],
+                                                           piece_state, available)
+                    else:
+                        requests[p.id] = []
+                        skipped_calls += 1
+            else:
+                t1 = clock()
+                requests = get_remote_requests(piece_state, available, completed,
+                                               downloads, uploads, changed)
+            changed = set()
+
+            t1b = clock()
+            requests_to = index_requests(requests)
+            t1c = clock()
+            if agent_pool is None:
+                uploads = dict()   # peer_id -> list of Uploads
+                for p in peers:
+                    if event_driven and idle_uploads(p, requests_to[p.id]):
+                        uploads[p.id] = []
+                        skipped_calls += 1
+                        continue
+                    if p.id not in h:
+                        h[p.id] = history.peer_history(p.id)
+                    uploads[p.id] = get_peer_uploads(requests_to[p.id], p,
+                                                     h[p.id])
+            else:
+                uploads = get_remote_uploads(requests_to)
+
+            t2 = clock()
+            (downloads, completed) = update_peer_pieces(
+                piece_state, requests, uploads, available, piece_counts,
+                unfinished, newly_done)
+            t3 = clock()
             history.update(downloads, uploads)
+            t4 = clock()
 
-            logging.debug(history.pretty_for_round(round))
+            if debug_on:
+                logging.debug(history.pretty_for_round(round))
 
-            log_peer_info(peer_pieces, available)
+            log_peer_info(piece_state, available)
+
+            if timer is not None:
+                # agent calls and checks are timed as they happen
+                timer.add("bookkeeping", (t1 - t0) + (t1c - t1b))
+                timer.add("update_peer_pieces", t3 - t2)
+                timer.add("history.update", t4 - t3)
+                timer.add("logging", clock() - t4)
            
-            if all_done(peer_pieces):
+            if all_done(unfinished, newly_done):
                 logging.info("All done!")                    
                 break
             round += 1
+            if checkpointer is not None and (round % conf.checkpoint_every == 0 or
+                                             round > conf.max_round):
+                start = clock()
+                checkpointer.save(self, round, peers, piece_state, history,
+                                  available, piece_counts, unfinished, topology)
+                if timer is not None:
+                    timer.add("checkpoint", clock() - start)
             if round > conf.max_round:
                 logging.info("Out of time.  Stopping.")
                 break
 
-        logging.info("Game history:\n%s" % history.pretty())
-
-        logging.info("======== STATS ========")
-        logging.info("Uploaded blocks:\n%s" %
-                     Stats.uploaded_blocks_str(self.peer_ids, history))
-        logging.info("Completion rounds:\n%s" %
-                     Stats.completion_rounds_str(self.peer_ids, history))
-        logging.info("All done round: %s" %
-                     Stats.all_done_round(self.peer_ids, history))
+        if topology.tracker is not None:
+            logging.info(topology.tracker.summary())
+        if event_driven:
+            logging.info("Event-driven engine skipped %d of %d agent calls",
+                         skipped_calls, 2 * len(peers) * (history.last_round() + 1))
+        if agent_pool is not None:
+            agent_pool.close()
+        if checkpointer is not None:
+            checkpointer.close()
+
+        stats_start = clock()
+        if info_on:
+            logging.info("Game history:\n%s", history.pretty())
+
+            logging.info("======== STATS ========")
+            logging.info("Uploaded blocks:\n%s",
+                         Stats.uploaded_blocks_str(self.peer_ids, history))
+            logging.info("Completion rounds:\n%s",
+                         Stats.completion_rounds_str(self.peer_ids, history))
+            logging.info("All done round: %s",
+                         Stats.all_done_round(self.peer_ids, history))
+        history.close()
+        if timer is not None:
+            timer.add("stats", clock() - stats_start)
 
         return history
 
     def run_sim(self):
-        histories = [self.run_sim_once() for i in range(self.config.iters)]
+        conf = self.config
+        self.peer_ids = peer_ids_for(conf.agent_class_names)
+
+        # Every iteration gets its own seed, so the results don't depend on
+        # which worker runs it or in what order.
+        base_seed = self.base_seed()
+        logging.info("Seed: %d", base_seed)
+        jobs = [(self, derive_seed(base_seed, i)) for i in range(conf.iters)]
+
+        workers = min(conf.workers, conf.iters)
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.map(run_iteration, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = list(map(run_iteration, jobs))
+
         logging.warning("======== SUMMARY STATS ========")
         
-        uploaded_blocks = [Stats.uploaded_blocks(self.peer_ids, h) for h in histories]
-        completion_rounds = [Stats.completion_rounds(self.peer_ids, h) for h in histories]
+        uploaded_blocks = [u for (u, c, t) in results]
+        completion_rounds = [c for (u, c, t) in results]
 
         def extract_by_peer_id(lst, peer_id):
             """Given a list of dicts, pull out the entry
@@ -367,7 +820,7 @@ class Sim:
         for p_id in sorted(self.peer_ids,
                            key=lambda id: mean(uploaded_by_id[id])):
             us = uploaded_by_id[p_id]
-            logging.warning("%s: %.1f  (%.1f)" % (p_id, mean(us), stddev(us)))
+            logging.warning("%s: %.1f  (%.1f)", p_id, mean(us), stddev(us))
 
         logging.warning("Completion rounds: avg (stddev)")
 
@@ -382,11 +835,48 @@ class Sim:
         opt_mean = optionize(mean)
         opt_stddev = optionize(stddev)
         
-        for p_id in sorted(self.peer_ids,
-                           key=lambda id: opt_mean(completion_by_id[id])):
+        def by_mean(id):
+            # Peers that did not always finish (None) go last
+            m = opt_mean(completion_by_id[id])
+            return (m is None, m)
+
+        for p_id in sorted(self.peer_ids, key=by_mean):
             cs = completion_by_id[p_id]
-            logging.warning("%s: %s  (%s)" % (p_id, opt_mean(cs), opt_stddev(cs)))
+            logging.warning("%s: %s  (%s)", p_id, opt_mean(cs), opt_stddev(cs))
 
+        if conf.timings:
+            phases = PhaseTimer()
+            for (u, c, (phase_timer, accounts)) in results:
+                phases.merge(phase_timer)
+
+            logging.warning("Time per phase: seconds  (% of total), all iterations")
+            logging.warning(phases.pretty())
+
+        if conf.timings or conf.time_budget is not None:
+            accounts = AgentAccounts()
+            for (u, c, (phase_timer, iter_accounts)) in results:
+                accounts.merge(iter_accounts)
+            self.log_agent_accounts(accounts)
+
+    def log_agent_accounts(self, accounts):
+        """Summarize the agent accounts by agent class"""
+        conf = self.config
+        class_of = dict(zip(self.peer_ids, conf.agent_class_names))
+        totals = dict()  # class name -> [wall, cpu, calls, violations]
+        for pid in self.peer_ids:
+            t = totals.setdefault(class_of[pid], [0.0, 0.0, 0, 0])
+            t[0] += accounts.wall.get(pid, 0.0)
+            t[1] += accounts.cpu.get(pid, 0.0)
+            t[2] += accounts.calls.get(pid, 0)
+        for (round, pid, name, seconds) in accounts.violations:
+            totals[class_of[pid]][3] += 1
+
+        logging.warning("Time per agent class: wall s, cpu s  "
+                        "(calls, wall ms per call, budget violations)")
+        for (name, (wall, cpu, calls, violations)) in sorted(
+                totals.items(), key=lambda item: -item[1][0]):
+            logging.warning("%s: %.3f, %.3f  (%d, %.3f, %d)", name, wall, cpu,
+                            calls, 1000.0 * wall / max(calls, 1), violations)
 
 
 def configure_logging(loglevel):
@@ -423,19 +913,150 @@ def parse_agents(args):
             
         
 
-def main(args):
-    usage_msg = "Usage:  %prog [options] PeerClass1[,count] PeerClass2[,count] ..."
+def build_parser(usage_msg):
+    """The options shared by a single simulation and a sweep"""
     parser = OptionParser(usage=usage_msg)
 
-    def usage(msg):
-        print("Error: %s\n" % msg)
-        parser.print_help()
-        sys.exit()
-    
     parser.add_option("--loglevel",
                       dest="loglevel", default="info",
                       help="Set the logging level: 'debug' or 'info'")
 
+    parser.add_option("--quiet",
+                      dest="quiet", default=False, action="store_true",
+                      help="Benchmark mode: no per-round output at all, just "
+                      "the summary stats.  Same as --loglevel warning")
+
+    parser.add_option("--timings",
+                      dest="timings", default=False, action="store_true",
+                      help="Time each phase of the simulation and each agent "
+                      "class, and add the totals to the summary stats")
+
+    parser.add_option("--profile",
+                      dest="profile", default=None,
+                      choices=["cprofile", "sample"],
+                      help="Profile the run: 'cprofile' (writes --profile-out) "
+                      "or 'sample' (low overhead, prints the hottest functions). "
+                      "Only profiles this process, not --workers")
+
+    parser.add_option("--profile-out",
+                      dest="profile_out", default="out.prof",
+                      help="Where --profile cprofile writes its stats")
+
+    parser.add_option("--time-budget",
+                      dest="time_budget", default=None, type="float",
+                      help="Per-round time budget for each agent, in ms, over "
+                      "its requests() and uploads() calls.  An agent that "
+                      "goes over gets no requests / uploads that round.  "
+                      "With --isolation process, an agent worker that takes "
+                      "far longer than its agents' budgets to reply is "
+                      "stopped, as if it had crashed.  Default: no budget")
+
+    parser.add_option("--budget-clock",
+                      dest="budget_clock", default="cpu",
+                      choices=BUDGET_CLOCKS,
+                      help="What --time-budget counts: 'cpu' (thread CPU "
+                      "time, the default) or 'wall' time")
+
+    parser.add_option("--isolation",
+                      dest="isolation", default="none",
+                      choices=["none", "process", "thread", "auto"],
+                      help="Where the agents run: 'none' (one after another, "
+                      "in the simulator's process), 'process' (in parallel, "
+                      "in --agent-workers worker processes that only see "
+                      "copies of the simulation state), 'thread' (in "
+                      "parallel on --agent-workers threads; only faster on a "
+                      "free-threaded python) or 'auto' (thread on a "
+                      "free-threaded python, process otherwise).  With "
+                      "process and thread, a crashing agent is logged and "
+                      "ignored")
+
+    parser.add_option("--agent-workers",
+                      dest="agent_workers", default=multiprocessing.cpu_count(),
+                      type="int",
+                      help="Number of processes or threads to run the agents "
+                      "in, with --isolation.  Default: one per CPU")
+
+    parser.add_option("--trusted-agents",
+                      dest="trusted_agents", default="",
+                      help="Comma separated agent classes whose requests and "
+                      "uploads are not checked, like the built-in Seed. "
+                      "Default: check every agent")
+
+    parser.add_option("--checkpoint",
+                      dest="checkpoint", default=None,
+                      help="Checkpoint the simulation to this file (and the "
+                      "latest state to FILE.state) every --checkpoint-every "
+                      "rounds, and when it runs out of rounds")
+
+    parser.add_option("--checkpoint-every",
+                      dest="checkpoint_every", default=100, type="int",
+                      help="Rounds between checkpoints (default 100)")
+
+    parser.add_option("--resume",
+                      dest="resume", default=None,
+                      help="Carry on from the checkpoint in this file. "
+                      "Give a larger --max-round to run for longer, and a "
+                      "different --checkpoint file to fork a new run off it")
+
+    parser.add_option("--history-window",
+                      dest="history_window", default=None, type="int",
+                      help="With --history stream, how many of the latest "
+                      "rounds to keep in memory for each agent, at least "
+                      "what its class declares in history_window.  Default: "
+                      "what it declares (every round if it doesn't)")
+
+    parser.add_option("--history-out",
+                      dest="history_out", default=None,
+                      help="With --history stream, the file to write every "
+                      "round to (FILE.SEED for each of several --iters, "
+                      "FILE.CONFIG.SEED in a sweep). "
+                      "Default: don't keep old rounds at all")
+
+    parser.add_option("--engine",
+                      dest="engine", default="round",
+                      choices=["round", "event"],
+                      help="'round' calls every agent every round.  'event' "
+                      "skips the calls that can't do anything: requests() "
+                      "of finished peers and uploads() of peers no one asked "
+                      "for anything, for agent classes that declare so (see "
+                      "Peer.idle_when_done).  Same results, faster late rounds")
+
+    parser.add_option("--topology",
+                      dest="topology", default="full",
+                      choices=sorted(TOPOLOGIES.keys()),
+                      help="Which peers each peer is connected to (sees, and "
+                      "can request from): 'full' (everyone), 'regular' "
+                      "(--degree random neighbors each), 'tracker' (--degree "
+                      "neighbors out of the peer lists of a tracker, see "
+                      "--announce-interval) or 'clustered' (--clusters "
+                      "groups with links between them)")
+
+    parser.add_option("--degree",
+                      dest="degree", default=50, type="int",
+                      help="Number of neighbors per peer, with --topology "
+                      "(default 50)")
+
+    parser.add_option("--announce-interval",
+                      dest="announce_interval", default=10, type="int",
+                      help="With --topology tracker, rounds between a peer's "
+                      "announces to the tracker (default 10)")
+
+    parser.add_option("--peer-list-size",
+                      dest="peer_list_size", default=50, type="int",
+                      help="With --topology tracker, the most peers the "
+                      "tracker returns for an announce (default 50)")
+
+    parser.add_option("--tracker-policy",
+                      dest="tracker_policy", default="random",
+                      choices=sorted(POLICIES.keys()),
+                      help="How the tracker picks the peers it returns: "
+                      "'random' or 'leechers' (peers still downloading first)")
+
+    parser.add_option("--clusters",
+                      dest="clusters", default=4, type="int",
+                      help="With --topology clustered, how many clusters "
+                      "(default 4)")
+
     parser.add_option("--num-pieces",
                       dest="num_pieces", default=3, type="int",
                       help="Set number of pieces in the file")
@@ -460,8 +1081,143 @@ def main(args):
                       dest="iters", default=1, type="int",
                       help="Number of times to run simulation to get stats")
 
+    parser.add_option("--workers",
+                      dest="workers", default=1, type="int",
+                      help="Number of processes to spread the iterations over")
+
+    parser.add_option("--seed",
+                      dest="seed", default=None, type="int",
+                      help="Seed for all the randomness in the simulation. "
+                      "The same seed gives the same results, however many "
+                      "--workers are used.  Default: a random seed")
+
+    parser.add_option("--piece-engine",
+                      dest="piece_engine", default="list",
+                      choices=sorted(ENGINES.keys()),
+                      help="How to store piece state: 'list', 'numpy' "
+                      "(one array for the whole swarm, needs numpy) or "
+                      "'sparse' (bitsets of completed pieces plus the pieces "
+                      "in progress, for huge files)")
+
+    parser.add_option("--history",
+                      dest="history", default="list",
+                      choices=sorted(HISTORIES.keys()),
+                      help="How to store the game history: 'list' (of message "
+                      "objects), 'columnar' (typed arrays, much smaller) or "
+                      "'stream' (only the rounds each agent needs in memory, "
+                      "see --history-window, and every round written to "
+                      "--history-out)")
+
+    return parser
+
+
+def check_options(options):
+    """Return an error message for a bad combination of options, or None"""
+    if options.piece_engine == "numpy" and piecestate.np is None:
+        return "--piece-engine numpy needs numpy installed"
+    if options.time_budget is not None and options.time_budget <= 0:
+        return "--time-budget must be positive"
+    if options.min_up_bw > options.max_up_bw:
+        return "--min-bw can't be more than --max-bw"
+    if resolve_isolation(options.isolation) == "process" and options.workers > 1:
+        # Pool workers are daemons, which can't start the agent workers
+        return "--isolation process needs --workers 1"
+    if options.checkpoint or options.resume:
+        if options.iters != 1:
+            return "--checkpoint and --resume need --iters 1"
+        if resolve_isolation(options.isolation) == "process":
+            return "--checkpoint and --resume can't be used with --isolation process"
+        if options.checkpoint_every < 1:
+            return "--checkpoint-every must be at least 1"
+    if options.engine == "event" and resolve_isolation(options.isolation) != "none":
+        return "--engine event needs --isolation none"
+    if options.history == "stream":
+        if options.checkpoint or options.resume:
+            return "--history stream can't be checkpointed"
+        if options.history_window is not None and options.history_window < 0:
+            return "--history-window can't be negative"
+    elif options.history_out:
+        return "--history-out needs --history stream"
+    if options.agent_workers < 1:
+        return "--agent-workers must be at least 1"
+    if options.degree < 1:
+        return "--degree must be at least 1"
+    if options.announce_interval < 1:
+        return "--announce-interval must be at least 1"
+    if options.peer_list_size < 1:
+        return "--peer-list-size must be at least 1"
+    if options.clusters < 1:
+        return "--clusters must be at least 1"
+    return None
+
+
+def make_config(options, agents_to_run, agent_classes=None):
+    """
+    Build the Params for a simulation out of parsed options.
+    agent_classes: dict class_name -> class, for callers that already loaded
+    the agent modules.  Loaded here otherwise.
+    """
+    if agent_classes is None:
+        agent_classes = load_modules(agents_to_run)
+
+    config = Params()
+
+    config.add("agent_class_names", agents_to_run)
+    config.add("agent_classes", agent_classes)
+
+    
+    config.add("num_pieces", options.num_pieces)
+    config.add("blocks_per_piece",options.blocks_per_piece)
+    config.add("max_round", options.max_round)
+    config.add("min_up_bw", options.min_up_bw)
+    config.add("max_up_bw", options.max_up_bw)
+    config.add("iters", options.iters)
+    config.add("workers", options.workers)
+    config.add("seed", options.seed)
+    config.add("timings", options.timings)
+    if options.time_budget is None:
+        config.add("time_budget", None)
+    else:
+        config.add("time_budget", options.time_budget / 1000.0)
+    config.add("budget_clock", options.budget_clock)
+    config.add("checkpoint", options.checkpoint)
+    config.add("checkpoint_every", options.checkpoint_every)
+    config.add("resume", options.resume)
+    config.add("trusted_agents",
+               [name for name in options.trusted_agents.split(",") if name])
+    config.add("isolation", resolve_isolation(options.isolation))
+    config.add("agent_workers", options.agent_workers)
+    config.add("piece_engine", options.piece_engine)
+    config.add("history", options.history)
+    config.add("engine", options.engine)
+    config.add("history_window", options.history_window)
+    config.add("history_out", options.history_out)
+    config.add("topology", options.topology)
+    config.add("degree", options.degree)
+    config.add("announce_interval", options.announce_interval)
+    config.add("peer_list_size", options.peer_list_size)
+    config.add("tracker_policy", options.tracker_policy)
+    config.add("clusters", options.clusters)
+    # Set by sweep.py to the configuration's id
+    config.add("sweep_config", None)
+    return config
+
 
-    (options, args) = parser.parse_args()
+def main(args):
+    if len(args) > 1 and args[1] == "sweep":
+        import sweep
+        return sweep.main(args[1:])
+
+    usage_msg = ("Usage:  %prog [options] PeerClass1[,count] PeerClass2[,count] ...\n"
+                 "        %prog sweep [options]   (see %prog sweep --help)")
+    parser = build_parser(usage_msg)
+
+    def usage(msg):
+        print("Error: %s\n" % msg)
+        parser.print_help()
+        sys.exit()
+    
+    (options, args) = parser.parse_args(args[1:])
 
     # leftover args are class names, with optional counts:
     # "Peer Seed[,4]"
@@ -475,26 +1231,19 @@ def main(args):
         except ValueError as e:
             usage(e)
     
-    configure_logging(options.loglevel)
-    config = Params()
-
-    config.add("agent_class_names", agents_to_run)
-    config.add("agent_classes", load_modules(config.agent_class_names))
+    error = check_options(options)
+    if error:
+        usage(error)
 
-    
-    config.add("num_pieces", options.num_pieces)
-    config.add("blocks_per_piece",options.blocks_per_piece)
-    config.add("max_round", options.max_round)
-    config.add("min_up_bw", options.min_up_bw)
-    config.add("max_up_bw", options.max_up_bw)
-    config.add("iters", options.iters)
+    configure_logging("warning" if options.quiet else options.loglevel)
+    config = make_config(options, agents_to_run)
     
     sim = Sim(config)
-    sim.run_sim()
+    if options.profile:
+        profiling.profile_call(options.profile, sim.run_sim, options.profile_out)
+    else:
+        sim.run_sim()
 
 if __name__ == "__main__":
-
-    # The next two lines are for profiling...
-    import cProfile
-    cProfile.run('main(sys.argv)', 'out.prof')
-#    main(sys.argv)
+    # Use --profile for profiling
+    main(sys.argv)
@@ -10,13 +10,8 @@ class Stats:
         Returns:
         dict: peer_id -> total upload blocks used
         """
-        uploaded = dict((peer_id, 0) for peer_id in peer_ids)
-        for peer_id in peer_ids:
-            for ds in history.downloads[peer_id]:
-                for download in ds:
-                    uploaded[download.from_id] += download.blocks
-                
-        return uploaded
+        totals = history.uploaded_totals()
+        return dict((peer_id, totals[peer_id]) for peer_id in peer_ids)
 
     @staticmethod
     def uploaded_blocks_str(peer_ids, history):
@@ -43,9 +38,10 @@ class Stats:
         """ Return a pretty stringified version of completion_rounds """
         d = Stats.completion_rounds(peer_ids, history)
 
-        k = lambda id: d[id]
+        # Peers that never finished (None) go last
+        k = lambda id: (d[id] is None, d[id])
         return "\n".join("%s: %s" % (id, d[id])
-                         for id in sorted(list(d.keys()), key=d.__getitem__))
+                         for id in sorted(list(d.keys()), key=k))
 
     @staticmethod
     def all_done_round(peer_ids, history):
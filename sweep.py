@@ -0,0 +1,197 @@
+#!/usr/bin/python
+
+"""
+Parameter sweeps: run the simulation for a grid (or an explicit list) of
+configurations and write one tidy results table, with one row per
+(configuration, iteration, peer).
+
+    python sim.py sweep --num-pieces 32,64 --max-bw 10,20 --iters 20 \\
+        --agents "AclaStd,5 Seed,2" --agents "AclaPropShare,5 Seed,2" \\
+        --workers 8 --out results.tsv
+
+    python sim.py sweep --topology tracker --peer-list-size 10,25,50 \\
+        --agents "AclaStd,10000 Seed,10" --out tracker.tsv
+
+All (configuration x iteration) cells are scheduled on a single process
+pool, and the agent modules are only loaded once for the whole sweep.
+"""
+
+import contextlib
+import copy
+import csv
+import itertools
+import json
+import multiprocessing
+import random
+import sys
+
+import sim
+from sim import Sim, run_iteration, parse_agents, peer_ids_for
+from util import derive_seed, load_modules
+
+# (dest, option) for the options that take a comma separated list of values
+GRID_OPTIONS = [("num_pieces", "--num-pieces"),
+                ("blocks_per_piece", "--blocks-per-piece"),
+                ("min_up_bw", "--min-bw"),
+                ("max_up_bw", "--max-bw"),
+                ("max_round", "--max-round"),
+                ("degree", "--degree"),
+                ("peer_list_size", "--peer-list-size")]
+
+COLUMNS = ["config", "num_pieces", "blocks_per_piece", "min_up_bw",
+           "max_up_bw", "max_round", "degree", "peer_list_size", "agents",
+           "iter", "peer_id", "agent_class", "uploaded_blocks",
+           "completion_round"]
+
+
+def parse_int_list(s):
+    """ "4,8,16" -> [4, 8, 16] """
+    return [int(x) for x in str(s).split(',')]
+
+
+def grid_points(options):
+    """
+    Return a list of dicts, one per configuration, mapping option dests
+    (and "agents") to values.  Either the configurations listed in the
+    --configs file, or the cartesian product of the grid options.
+    """
+    defaults = dict((dest, parse_int_list(getattr(options, dest))[0])
+                    for (dest, _) in GRID_OPTIONS)
+    defaults["agents"] = options.agents[0]
+
+    if options.configs:
+        with open(options.configs) as f:
+            listed = json.load(f)
+        points = []
+        for entry in listed:
+            point = dict(defaults)
+            point.update(entry)
+            points.append(point)
+        return points
+
+    dests = [dest for (dest, _) in GRID_OPTIONS]
+    values = [parse_int_list(getattr(options, dest)) for dest in dests]
+    points = []
+    for combo in itertools.product(*(values + [options.agents])):
+        point = dict(zip(dests + ["agents"], combo))
+        # Leave out the bandwidth ranges the product makes empty, rather
+        # than fail check_options on them
+        if point["min_up_bw"] > point["max_up_bw"]:
+            continue
+        points.append(point)
+    return points
+
+
+def run_cell(job):
+    """
+    run_iteration, with whatever the agents print sent to stderr, so it
+    doesn't end up in a results table written to stdout.
+    """
+    with contextlib.redirect_stdout(sys.stderr):
+        return run_iteration(job)
+
+
+def result_rows(config_id, point, iteration, peer_ids, agent_class_names, result):
+    (uploaded, completion, timers) = result
+    for (peer_id, class_name) in zip(peer_ids, agent_class_names):
+        done = completion[peer_id]
+        yield [config_id, point["num_pieces"], point["blocks_per_piece"],
+               point["min_up_bw"], point["max_up_bw"], point["max_round"],
+               point["degree"], point["peer_list_size"], point["agents"],
+               iteration, peer_id, class_name, uploaded[peer_id],
+               "" if done is None else done]
+
+
+def main(args):
+    usage_msg = ("Usage:  %prog sweep [options]\n\n"
+                 "Options marked LIST take a comma separated list of values; "
+                 "every combination is run.")
+    parser = sim.build_parser(usage_msg)
+    parser.set_conflict_handler("resolve")
+
+    def usage(msg):
+        print("Error: %s\n" % msg)
+        parser.print_help()
+        sys.exit()
+
+    for (dest, opt) in GRID_OPTIONS:
+        default = parser.defaults[dest]
+        help = parser.get_option(opt).help
+        parser.add_option(opt, dest=dest, default=str(default),
+                          help="LIST. %s" % help)
+
+    parser.add_option("--agents",
+                      dest="agents", action="append", default=[],
+                      help="An agent mix, like \"AclaStd,5 Seed,2\".  "
+                      "Repeat the option to sweep over several mixes")
+
+    parser.add_option("--configs",
+                      dest="configs", default=None,
+                      help="JSON file with a list of configurations to run "
+                      "instead of the grid.  Each is a dict of option names "
+                      "(num_pieces, max_up_bw, agents, ...) to values")
+
+    parser.add_option("--out",
+                      dest="out", default=None,
+                      help="Where to write the results table (tab separated). "
+                      "Default: stdout")
+
+    parser.set_defaults(loglevel="warning",
+                        workers=multiprocessing.cpu_count())
+
+    (options, args) = parser.parse_args(args[1:])
+    if len(args) > 0:
+        usage("Unexpected arguments: %s" % " ".join(args))
+    if len(options.agents) == 0:
+        options.agents = ["Dummy,2 Seed"]
+    if options.checkpoint or options.resume:
+        usage("--checkpoint and --resume can't be used in a sweep")
+
+    try:
+        points = grid_points(options)
+        mixes = [parse_agents(point["agents"].split()) for point in points]
+    except ValueError as e:
+        usage(e)
+
+    sim.configure_logging("warning" if options.quiet else options.loglevel)
+
+    # Load every agent module once, and share the classes between configs
+    agent_classes = load_modules(sorted(set(itertools.chain(*mixes))))
+
+    if options.seed is not None:
+        base_seed = options.seed
+    else:
+        base_seed = random.randrange(2**32)
+    jobs = []
+    cells = []   # (config id, point, iteration, peer ids, class names)
+    for (config_id, (point, agents_to_run)) in enumerate(zip(points, mixes)):
+        opts = copy.copy(options)
+        for (dest, value) in point.items():
+            setattr(opts, dest, value)
+        error = sim.check_options(opts)
+        if error:
+            usage(error)
+        conf = sim.make_config(opts, agents_to_run, agent_classes)
+        conf.add("sweep_config", config_id)
+        s = Sim(conf)
+        peer_ids = peer_ids_for(agents_to_run)
+        for i in range(options.iters):
+            jobs.append((s, derive_seed(base_seed, config_id, i)))
+            cells.append((config_id, point, i, peer_ids, agents_to_run))
+
+    out = open(options.out, "w", newline="") if options.out else sys.stdout
+    writer = csv.writer(out, delimiter="\t", lineterminator="\n")
+    writer.writerow(COLUMNS)
+
+    workers = min(options.workers, len(jobs))
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        results = pool.imap(run_cell, jobs) if pool else map(run_cell, jobs)
+        for (cell, result) in zip(cells, results):
+            writer.writerows(result_rows(*(cell + (result,))))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if out is not sys.stdout:
+            out.close()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+"""
+Lightweight wall clock timing of the phases of a simulation.
+"""
+
+import time
+
+clock = time.perf_counter
+
+
+class PhaseTimer:
+    """
+    totals: dict : phase name -> seconds spent in it
+    counts: dict : phase name -> number of times it was timed
+    Phases are kept in the order they were first seen.
+    """
+    def __init__(self):
+        self.totals = dict()
+        self.counts = dict()
+
+    def add(self, phase, seconds):
+        self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+
+    def merge(self, other):
+        """Add the totals of another PhaseTimer to this one"""
+        for phase in other.totals:
+            self.totals[phase] = self.totals.get(phase, 0.0) + other.totals[phase]
+            self.counts[phase] = self.counts.get(phase, 0) + other.counts[phase]
+
+    def total(self):
+        return sum(self.totals.values())
+
+    def pretty(self):
+        total = self.total() or 1.0
+        return "\n".join("%-20s %9.3fs  %5.1f%%" % (
+            phase, seconds, 100.0 * seconds / total)
+                         for (phase, seconds) in self.totals.items())
+
+
+cpu_clock = time.thread_time
+
+BUDGET_CLOCKS = ["cpu", "wall"]
+
+
+def timed_call(f, *args):
+    """Call f(*args).  Returns (result, wall seconds, cpu seconds)"""
+    wall_start = clock()
+    cpu_start = cpu_clock()
+    result = f(*args)
+    cpu = cpu_clock() - cpu_start
+    return (result, clock() - wall_start, cpu)
+
+
+class AgentAccounts:
+    """
+    Wall and CPU time spent in each peer's requests() and uploads() calls,
+    with an optional per-round time budget.
+
+    budget: seconds a peer may spend per round, over both calls, or None
+    budget_clock: "cpu" or "wall", the time the budget is checked against
+    wall, cpu: dict : peer_id -> seconds, over all rounds
+    calls: dict : peer_id -> number of calls
+    violations: list of (round, peer_id, call, seconds charged that round)
+    """
+    def __init__(self, budget=None, budget_clock="cpu"):
+        if budget_clock not in BUDGET_CLOCKS:
+            raise ValueError("Unknown budget clock: %s" % budget_clock)
+        self.budget = budget
+        self.budget_clock = budget_clock
+        self.wall = dict()
+        self.cpu = dict()
+        self.calls = dict()
+        self.violations = []
+        self.round = None
+        self.spent = dict()   # peer_id -> seconds charged this round
+
+    def over_budget(self, round, peer_id):
+        """Has this peer used up its budget for this round already?"""
+        if self.budget is None or round != self.round:
+            return False
+        return self.spent.get(peer_id, 0.0) > self.budget
+
+    def charge(self, round, peer_id, name, wall, cpu):
+        """
+        Charge a call (timed with timed_call) to peer_id.  name is the call
+        ("requests" or "uploads"), for the violations list.  Returns False if
+        that puts the peer over its budget for the round.
+        """
+        if round != self.round:
+            self.round = round
+            self.spent = dict()
+        self.wall[peer_id] = self.wall.get(peer_id, 0.0) + wall
+        self.cpu[peer_id] = self.cpu.get(peer_id, 0.0) + cpu
+        self.calls[peer_id] = self.calls.get(peer_id, 0) + 1
+        if self.budget is None:
+            return True
+        spent = self.spent.get(peer_id, 0.0) + (cpu if self.budget_clock == "cpu"
+                                                else wall)
+        self.spent[peer_id] = spent
+        if spent > self.budget:
+            self.violations.append((round, peer_id, name, spent))
+            return False
+        return True
+
+    def merge(self, other):
+        """Add the totals and violations of another AgentAccounts to this one"""
+        for pid in other.calls:
+            self.wall[pid] = self.wall.get(pid, 0.0) + other.wall[pid]
+            self.cpu[pid] = self.cpu.get(pid, 0.0) + other.cpu[pid]
+            self.calls[pid] = self.calls.get(pid, 0) + other.calls[pid]
+        self.violations.extend(other.violations)
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+
+"""
+Overlay topologies: which peers each peer is connected to, and so which
+PeerInfo it is shown and which peers it may send requests to.
+
+  - FullTopology connects everyone to everyone (the original behaviour).
+  - RegularTopology is a random graph where every peer has degree neighbors.
+  - TrackerTopology is built from the peer lists of a simulated tracker
+    (see tracker.py).  Peers announce every so many rounds: they drop the
+    connections that are no use any more (both ends have the whole file)
+    and top up to degree neighbors.
+  - ClusteredTopology splits the peers into clusters, with a random regular
+    graph inside each one and a link from every peer to another cluster.
+
+Connections are symmetric.  Topologies change incrementally: update()
+returns the peers whose neighbors changed, so the sim only rebuilds their
+neighbor lists.  Everything random comes from the rng the topology is given.
+
+NeighborhoodCounts keeps the piece counts agents see in their history when
+the topology is bounded: over the peer and its neighbors, not the swarm.
+They are only counted for the pieces agents look up.
+"""
+
+from collections.abc import Sequence
+
+from util import even_split
+
+
+class FullTopology:
+    """
+    neighbors: None, everyone is connected to everyone
+    tracker: the Tracker the topology comes from, if any
+    """
+    tracker = None
+
+    def __init__(self, peer_ids, degree, rng):
+        self.peer_ids = peer_ids[:]
+        self.degree = degree
+        self.neighbors = None
+
+    def neighbor_ids(self, peer_id):
+        """The ids of peer_id's neighbors, in peer order"""
+        return [pid for pid in self.peer_ids if pid != peer_id]
+
+    def update(self, round, unfinished):
+        """
+        Called at the start of every round.  unfinished: set of the ids of
+        the peers still missing pieces.  Returns the set of peers whose
+        neighbors changed.
+        """
+        return set()
+
+
+class Topology(FullTopology):
+    """
+    neighbors: dict : peer_id -> set(ids of its neighbors)
+    """
+    def __init__(self, peer_ids, degree, rng):
+        FullTopology.__init__(self, peer_ids, degree, rng)
+        self.rng = rng
+        self.index = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+        self.neighbors = dict((pid, set()) for pid in peer_ids)
+
+    def neighbor_ids(self, peer_id):
+        return sorted(self.neighbors[peer_id], key=self.index.__getitem__)
+
+    def connect(self, a, b):
+        self.neighbors[a].add(b)
+        self.neighbors[b].add(a)
+
+    def disconnect(self, a, b):
+        self.neighbors[a].discard(b)
+        self.neighbors[b].discard(a)
+
+    def connect_regular(self, ids, degree):
+        """
+        Connect ids into a random graph where each has degree neighbors
+        (degree - 1 if degree and len(ids) are both odd): a ring lattice
+        over a shuffled order, randomized with degree-preserving edge swaps.
+        """
+        n = len(ids)
+        degree = min(degree, n - 1)
+        if degree <= 0:
+            return
+        order = ids[:]
+        self.rng.shuffle(order)
+        edges = []
+        for i in range(n):
+            for k in range(1, degree // 2 + 1):
+                edges.append((order[i], order[(i + k) % n]))
+            if degree % 2 == 1 and n % 2 == 0 and i < n // 2:
+                edges.append((order[i], order[i + n // 2]))
+        for (a, b) in edges:
+            self.connect(a, b)
+
+        if degree >= n - 1:
+            return  # complete, nothing to swap
+        for _ in range(len(edges)):
+            (i, j) = (self.rng.randrange(len(edges)), self.rng.randrange(len(edges)))
+            ((a, b), (c, d)) = (edges[i], edges[j])
+            if (len(set((a, b, c, d))) < 4 or d in self.neighbors[a] or
+                    b in self.neighbors[c]):
+                continue
+            self.disconnect(a, b)
+            self.disconnect(c, d)
+            self.connect(a, d)
+            self.connect(c, b)
+            (edges[i], edges[j]) = ((a, d), (c, b))
+
+
+class RegularTopology(Topology):
+    def __init__(self, peer_ids, degree, rng):
+        Topology.__init__(self, peer_ids, degree, rng)
+        self.connect_regular(self.peer_ids, degree)
+
+
+class TrackerTopology(Topology):
+    """
+    Built from a Tracker's peer lists.  Peers accept connections up to
+    twice degree, like BitTorrent clients that want 50 peers and allow 80
+    connections.  On each announce, a finished peer drops its links to other
+    finished peers; then the peer connects to the peers in the list, except
+    two finished ones, until it has degree neighbors.
+    """
+    def __init__(self, peer_ids, degree, rng, tracker, unfinished):
+        Topology.__init__(self, peer_ids, degree, rng)
+        self.tracker = tracker
+        self.max_connections = 2 * degree
+        order = self.peer_ids[:]
+        rng.shuffle(order)
+        for pid in order:
+            self.announce(0, pid, unfinished)
+
+    def announce(self, round, peer_id, unfinished):
+        done = peer_id not in unfinished
+        mine = self.neighbors[peer_id]
+        if done:
+            for other in [n for n in mine if n not in unfinished]:
+                self.disconnect(peer_id, other)
+        for pid in self.tracker.announce(round, peer_id, done):
+            if len(mine) >= self.degree:
+                break
+            if (pid not in mine and (not done or pid in unfinished) and
+                    len(self.neighbors[pid]) < self.max_connections):
+                self.connect(peer_id, pid)
+
+    def update(self, round, unfinished):
+        changed = set()
+        if round == 0:
+            return changed
+        for pid in self.tracker.due(round):
+            before = set(self.neighbors[pid])
+            self.announce(round, pid, unfinished)
+            after = self.neighbors[pid]
+            if after != before:
+                changed.add(pid)
+                changed.update(before ^ after)
+        return changed
+
+
+class ClusteredTopology(Topology):
+    """
+    clusters: how many clusters.  Inside a cluster, every peer has
+    degree - 1 neighbors; then every peer connects to a random peer in
+    another cluster, so peers end up with about degree + 1.
+    """
+    def __init__(self, peer_ids, degree, rng, clusters):
+        Topology.__init__(self, peer_ids, degree, rng)
+        order = self.peer_ids[:]
+        rng.shuffle(order)
+        clusters = max(1, min(clusters, len(order)))
+        self.cluster_of = dict()
+        start = 0
+        for (c, size) in enumerate(even_split(len(order), clusters)):
+            members = order[start:start + size]
+            start += size
+            for pid in members:
+                self.cluster_of[pid] = c
+            self.connect_regular(members, degree - 1)
+        if clusters == 1:
+            return
+        for pid in self.peer_ids:
+            while True:
+                other = rng.choice(self.peer_ids)
+                if self.cluster_of[other] != self.cluster_of[pid]:
+                    break
+            self.connect(pid, other)
+
+
+TOPOLOGIES = {"full": FullTopology,
+              "regular": RegularTopology,
+              "tracker": TrackerTopology,
+              "clustered": ClusteredTopology}
+
+
+def make_topology(kind, peer_ids, degree, rng, clusters=4, tracker=None,
+                  unfinished=()):
+    """
+    kind: one of the keys of TOPOLOGIES
+    degree: how many neighbors each peer should have
+    clusters: for a ClusteredTopology, how many clusters
+    tracker, unfinished: for a TrackerTopology, the Tracker, and the peers
+    that start out missing pieces
+    """
+    if kind not in TOPOLOGIES:
+        raise ValueError("Unknown topology: %s" % kind)
+    if kind == "tracker":
+        return TrackerTopology(peer_ids, degree, rng, tracker, unfinished)
+    if kind == "clustered":
+        return ClusteredTopology(peer_ids, degree, rng, clusters)
+    return TOPOLOGIES[kind](peer_ids, degree, rng)
+
+
+class NeighborhoodView(Sequence):
+    """
+    Read-only view of the piece counts over one peer's neighborhood (members:
+    the peer and its neighbors), indexed like a list of num_pieces counts.
+    A piece's count is worked out from the members' available pieces the
+    first time it is read, and kept in known, which completed() keeps up to
+    date.  So it only costs memory for the pieces an agent has looked at.
+    """
+    __slots__ = ("available", "num_pieces", "members", "known")
+
+    def __init__(self, available, num_pieces, members):
+        self.available = available
+        self.num_pieces = num_pieces
+        self.members = members
+        self.known = dict()   # piece_id -> count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(self.num_pieces))]
+        if i < 0:
+            i += self.num_pieces
+        if not 0 <= i < self.num_pieces:
+            raise IndexError("piece index out of range")
+        count = self.known.get(i)
+        if count is None:
+            count = sum(1 for pid in self.members if i in self.available[pid])
+            self.known[i] = count
+        return count
+
+    def __len__(self):
+        return self.num_pieces
+
+    def __iter__(self):
+        # Every count at once: a pass over the members' pieces, not cached
+        counts = [0] * self.num_pieces
+        for pid in self.members:
+            for piece_id in self.available[pid]:
+                counts[piece_id] += 1
+        return iter(counts)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class NeighborhoodCounts:
+    """
+    available: dict : peer_id -> the pieces that peer has
+    views: dict : peer_id -> NeighborhoodView, its counts, for its history
+    watchers: dict : peer_id -> set(ids of the peers whose counts include it)
+    """
+    def __init__(self, num_pieces, available):
+        self.num_pieces = num_pieces
+        self.available = available
+        self.views = dict()
+        self.watchers = dict()
+
+    def rebuild(self, peer_id, neighbor_ids):
+        """peer_id's neighbors changed: forget the counts it had"""
+        view = self.views.get(peer_id)
+        if view is not None:
+            for pid in view.members:
+                self.watchers[pid].discard(peer_id)
+        members = [peer_id] + list(neighbor_ids)
+        for pid in members:
+            self.watchers.setdefault(pid, set()).add(peer_id)
+        if view is None:
+            self.views[peer_id] = NeighborhoodView(self.available,
+                                                   self.num_pieces, members)
+        else:
+            view.members = members   # keep the view
+            view.known.clear()
+
+    def completed(self, peer_id, piece_id):
+        """peer_id just finished piece_id"""
+        for pid in self.watchers.get(peer_id, ()):
+            known = self.views[pid].known
+            if piece_id in known:
+                known[piece_id] += 1
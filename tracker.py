@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+"""
+A simulated BitTorrent tracker, for --topology tracker.
+
+Peers announce to the tracker at round 0 and then every interval rounds,
+each at its own offset, so the announces are spread over the rounds.  An
+announce says whether the peer has finished, and gets back a list of at
+most peer_list_size other peers, picked by a selection policy:
+
+  - random: any peers in the swarm.
+  - leechers: peers still downloading first, then finished ones.
+
+The tracker indexes the swarm by whether peers have finished, and the
+announce schedule by round, so an announce and a round's worth of them
+don't depend on the size of the swarm.  load records how many announces
+it got in each round.
+"""
+
+
+class IndexedList:
+    """A list of ids with O(1) membership, add and remove (order isn't kept)"""
+    def __init__(self, ids=()):
+        self.ids = []
+        self.pos = dict()
+        for i in ids:
+            self.add(i)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, i):
+        return i in self.pos
+
+    def add(self, i):
+        if i not in self.pos:
+            self.pos[i] = len(self.ids)
+            self.ids.append(i)
+
+    def remove(self, i):
+        k = self.pos.pop(i)
+        last = self.ids.pop()
+        if last != i:
+            self.ids[k] = last
+            self.pos[last] = k
+
+
+def sample(rng, ids, k, exclude):
+    """Up to k random ids out of the list ids, leaving out exclude"""
+    picked = rng.sample(ids, min(len(ids), k + 1))
+    return [i for i in picked if i != exclude][:k]
+
+
+def select_random(tracker, peer_id):
+    return sample(tracker.rng, tracker.peer_ids, tracker.peer_list_size, peer_id)
+
+
+def select_leechers(tracker, peer_id):
+    k = tracker.peer_list_size
+    ans = sample(tracker.rng, tracker.leechers.ids, k, peer_id)
+    if len(ans) < k:
+        ans.extend(sample(tracker.rng, tracker.seeds.ids, k - len(ans), peer_id))
+    return ans
+
+
+POLICIES = {"random": select_random,
+            "leechers": select_leechers}
+
+
+class Tracker:
+    """
+    unfinished: ids of the peers that start without the whole file
+    interval: rounds between a peer's announces
+    peer_list_size: the most peers an announce returns
+    policy: one of the keys of POLICIES
+    """
+    def __init__(self, peer_ids, unfinished, rng, interval, peer_list_size,
+                 policy="random"):
+        if policy not in POLICIES:
+            raise ValueError("Unknown tracker policy: %s" % policy)
+        self.peer_ids = peer_ids[:]
+        self.rng = rng
+        self.interval = interval
+        self.peer_list_size = peer_list_size
+        self.policy = policy
+        self.leechers = IndexedList(pid for pid in peer_ids if pid in unfinished)
+        self.seeds = IndexedList(pid for pid in peer_ids if pid not in unfinished)
+        # schedule[k]: the peers announcing in rounds r with r % interval == k
+        self.schedule = [[] for _ in range(interval)]
+        for pid in peer_ids:
+            self.schedule[rng.randrange(interval)].append(pid)
+        self.load = []   # announces in each round
+
+    def due(self, round):
+        """The peers that announce this round (after round 0)"""
+        self.add_rounds(round)
+        return self.schedule[round % self.interval]
+
+    def add_rounds(self, round):
+        while len(self.load) <= round:
+            self.load.append(0)
+
+    def announce(self, round, peer_id, done):
+        """
+        peer_id announces, saying whether it has finished (done).
+        Returns a list of other peer ids.
+        """
+        self.add_rounds(round)
+        self.load[round] += 1
+        if done and peer_id in self.leechers:
+            self.leechers.remove(peer_id)
+            self.seeds.add(peer_id)
+        return POLICIES[self.policy](self, peer_id)
+
+    def summary(self):
+        """One line about the announce load"""
+        total = sum(self.load)
+        rounds = max(1, len(self.load))
+        return ("Tracker got %d announces in %d rounds: %.1f per round, at "
+                "most %d (peer lists of up to %d, %s policy)" % (
+                    total, rounds, total / float(rounds), max(self.load or [0]),
+                    self.peer_list_size, self.policy))
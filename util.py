@@ -5,6 +5,7 @@
 # http://stackoverflow.com/questions/5098580/implementing-argmax-in-python
 
 from itertools import count
+from collections.abc import Sequence
 import math
 
 
@@ -56,6 +57,15 @@ def median(numeric):
 
 
 
+def derive_seed(*parts):
+    """
+    Combine parts (numbers, ids, ...) into a seed for random.seed().
+    String seeds are hashed with sha512 by the random module, so the result
+    is the same in every process and every python run.
+    """
+    return "-".join(str(p) for p in parts)
+
+
 def even_split(n, k):
     """
     n and k must be ints.
@@ -100,6 +110,32 @@ def load_modules(agent_classes):
     
 
 
+class ReadOnlyList(Sequence):
+    """
+    A view of a list that can be indexed, sliced and iterated over, but not
+    changed.  It reflects later changes to the underlying list.
+    """
+    __slots__ = ("_items",)
+
+    def __init__(self, items):
+        self._items = items
+
+    def __getitem__(self, i):
+        return self._items[i]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(self._items)
+
+
 class Params:
     def __init__(self):
         self._init_keys = set(self.__dict__.keys())